@@ -0,0 +1,96 @@
+#!/usr/bin/python
+"""
+aio.py: asyncio facade for Fireplace.
+
+Commands run on a single thread executor that owns the radio, so encoding and the blocking USB transfers stay off the
+event loop, and one loop can drive many fireplaces and sensors without a thread per device. Fireplaces sharing a radio
+should share one executor, see radio_executor.
+
+Cancelling aset() only stops the command if the executor has not started it yet. Once it has started the new state
+goes on air and into the model as usual, and only the wait for it is abandoned.
+"""
+
+import asyncio
+import functools
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .fireplace import validate
+
+# Changes an iterator buffers for a slow consumer before dropping the oldest
+DEFAULT_CHANGES_SIZE = 16
+
+
+def radio_executor():
+    """A single thread executor to own one radio, shared by every AsyncFireplace using that radio"""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix='fireplace-radio')
+
+
+class AsyncFireplace(object):
+    """Wraps a Fireplace with coroutines, running blocking work on a radio executor"""
+
+    def __init__(self, fireplace, executor=None):
+        self._fireplace = fireplace
+        self._owns_executor = executor is None
+        self._executor = radio_executor() if executor is None else executor
+
+    @property
+    def fireplace(self):
+        return self._fireplace
+
+    def submit(self, force=False, **values):
+        """Check the values and queue the command on the radio executor, returning an asyncio Future for it
+
+        Raises ValueError right away for bad values, before anything is queued."""
+        validate(**values)
+        return asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(self._fireplace.set, force=force, **values))
+
+    async def aset(self, force=False, **values):
+        """Change the given values and transmit the new state, returning what Fireplace.set returns once it is sent
+
+        With a worker the result is that of its Future, awaited without blocking the loop."""
+        result = await self.submit(force, **values)
+        if isinstance(result, Future):
+            result = await asyncio.wrap_future(result)
+        return result
+
+    def run(self, function, *args, **kwargs):
+        """Run any other blocking call that uses the radio, like a registry group command, on the radio executor"""
+        return asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(function, *args,
+                                                                                            **kwargs))
+
+    async def astate(self):
+        """The current state dict, read from the immutable snapshot without waiting on the radio"""
+        return self._fireplace.state
+
+    async def changes(self, maxsize=DEFAULT_CHANGES_SIZE):
+        """Async iterator of each FireplaceState sent from now on, for 'async for state in afp.changes()'
+
+        A consumer that falls more than maxsize changes behind loses the oldest ones, since only the latest state
+        matters. Closing the iterator, or cancelling the task using it, stops listening."""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize)
+
+        def offer(state):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(state)
+
+        def listener(fireplace, state):
+            try:
+                loop.call_soon_threadsafe(offer, state)
+            except RuntimeError:
+                logging.debug('Event loop closed, dropping fireplace change')
+
+        self._fireplace.add_listener(listener)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._fireplace.remove_listener(listener)
+
+    async def aclose(self):
+        """Wait for running commands and shut down the executor if this facade created it"""
+        if self._owns_executor:
+            await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown)
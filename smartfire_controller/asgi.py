@@ -0,0 +1,353 @@
+#!/usr/bin/python
+"""
+asgi.py: asyncio REST server providing access to the Proflame 2 controller, with the same routes as server.py.
+
+GETs are answered from the in memory state without touching the radio. PUTs are checked on the event loop and handed
+to a single thread executor that owns the radio, so the loop never blocks on a burst. By default a PUT answers once
+its command is on air, a request with the header 'Prefer: respond-async' gets a 202 as soon as it is queued instead.
+
+Serve create_app() with any ASGI server, like 'uvicorn --factory asgi:create_app', or run 'python asgi.py' with uvicorn
+installed. With SMARTFIRE_BROKER set, any number of workers share the radio through broker.py, and reads of the state
+go to the broker from the executor too, while event streams wait on the broker with asyncio.
+"""
+
+import asyncio
+import functools
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+if not __package__:
+    # run as a script, or imported from this directory, load the modules below as part of the package
+    import os
+    import sys
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = os.path.basename(os.path.dirname(os.path.abspath(__file__)))
+    __import__(__package__)
+
+from .aio import AsyncFireplace, radio_executor
+from .broker import connect
+from .cache import RegistryCache, etag_matches
+from .events import KEEPALIVE, POLL_TIMEOUT, StateEvents, parse_event_id, poll_json, sse_message
+from .fireplace import validate
+from .registry import from_environment
+from .state import BOOLEAN_FIELDS, LEVEL_FIELDS, json_values, parse_value, turns_off
+
+VALUE_FIELDS = BOOLEAN_FIELDS + LEVEL_FIELDS
+
+
+class HttpError(Exception):
+    """Ends a request with the given status and plain text message"""
+
+    def __init__(self, status, message):
+        super(HttpError, self).__init__(message)
+        self.status = status
+
+
+class Request(object):
+    """The parts of an ASGI http scope the routes need"""
+
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = [part for part in scope['path'].split('/') if part]
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        self.query = {name: values[-1] for name, values in parse_qs(scope.get('query_string', b'').decode()).items()}
+        self.body = body
+
+    @property
+    def respond_async(self):
+        """Whether the client asked for a 202 once the command is queued, rather than waiting until it is on air"""
+        return 'respond-async' in self.headers.get('prefer', '')
+
+    def text(self):
+        return self.body.decode('utf-8')
+
+    def json(self):
+        try:
+            return json.loads(self.text())
+        except ValueError:
+            raise HttpError(400, 'Body is not valid JSON')
+
+
+class Response(object):
+
+    def __init__(self, body, status=200, content_type='text/html; charset=utf-8', etag=None):
+        self.body = body if isinstance(body, bytes) else body.encode('utf-8')
+        self.status = status
+        self.content_type = content_type
+        self.etag = etag
+
+    @classmethod
+    def json(cls, value, status=200):
+        return cls(json.dumps(value), status, 'application/json')
+
+    @classmethod
+    def cached(cls, request, response, content_type='text/html; charset=utf-8'):
+        """Serve a pre-encoded (etag, body) from the cache, or 304 Not Modified if the client already has it"""
+        etag, body = response
+        if etag_matches(request.headers.get('if-none-match'), etag):
+            return cls(b'', 304, content_type, etag)
+        return cls(body, 200, content_type, etag)
+
+    async def send(self, send, receive):
+        headers = [(b'content-type', self.content_type.encode('latin-1')),
+                   (b'content-length', str(len(self.body)).encode('latin-1'))]
+        if self.etag is not None:
+            headers.append((b'etag', self.etag.encode('latin-1')))
+        await send({'type': 'http.response.start', 'status': self.status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': self.body})
+
+
+class EventStreamResponse(object):
+    """Server-Sent Events of state changes after the EventId, until the client disconnects"""
+
+    def __init__(self, events, last):
+        self._events = events
+        self._last = last
+
+    async def send(self, send, receive):
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache')]})
+        disconnected = asyncio.ensure_future(_disconnect(receive))
+        last = self._last
+        try:
+            changes = await self._events.wait_async(last, 0)
+            while True:
+                for event in changes:
+                    last = event[0]
+                    await send({'type': 'http.response.body', 'body': sse_message(event).encode(), 'more_body': True})
+                waiting = asyncio.ensure_future(self._events.wait_async(last, KEEPALIVE))
+                await asyncio.wait([waiting, disconnected], return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done():
+                    waiting.cancel()
+                    return
+                changes = waiting.result()
+                if not changes:
+                    await send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+        finally:
+            disconnected.cancel()
+
+
+async def _disconnect(receive):
+    """Wait for the client to go away"""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+class SmartfireApp(object):
+    """ASGI application serving a FireplaceRegistry, the unscoped routes control its first fireplace"""
+
+    def __init__(self, registry, executor=None, events=None, blocking_reads=False):
+        self._registry = registry
+        self._executor = radio_executor() if executor is None else executor
+        self._blocking_reads = blocking_reads  # reading the state waits on I/O, like a broker's RemoteRegistry
+        self._units = {key: AsyncFireplace(registry.get(key), self._executor) for key in registry.ids()}
+        self._default = self._units[registry.ids()[0]]
+        self._events = StateEvents(registry) if events is None else events
+        self._caches = RegistryCache(registry)  # pre-encoded GET bodies
+        self._keys = {unit: key for key, unit in self._units.items()}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        request = Request(scope, body)
+        try:
+            response = await self.route(request)
+        except HttpError as e:
+            response = Response(str(e), e.status, 'text/plain; charset=utf-8')
+        except Exception:
+            logging.exception('Request {} {} failed'.format(request.method, scope['path']))
+            response = Response('Internal server error', 500, 'text/plain; charset=utf-8')
+        await response.send(send, receive)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self._executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def route(self, request):
+        path = request.path
+        if path == ['state']:
+            return await self.legacy_state(request, self._default)
+        if path == ['serial']:
+            self._allow(request, 'GET')
+            return Response.cached(request, await self._read(self._cache(self._default).value, 'serial'))
+        if len(path) == 1 and path[0] in VALUE_FIELDS:
+            return await self.value(request, self._default, path[0])
+        if path == ['fireplaces']:
+            self._allow(request, 'GET')
+            return Response.cached(request, await self._read(self._caches.all), 'application/json')
+        if path == ['fireplaces', 'stats']:
+            self._allow(request, 'GET')
+            return Response.json(await self._read(lambda: self._registry.stats))
+        if path == ['fireplaces', 'off']:
+            self._allow(request, 'POST')
+            return await self.group(request, functools.partial(self._registry.all_off, force=True))
+        if path == ['scene']:
+            return await self.scene(request)
+        if path == ['events']:
+            self._allow(request, 'GET')
+            return EventStreamResponse(self._events, parse_event_id(request.headers.get('last-event-id',
+                                                                                        request.query.get('since'))))
+        if path == ['events', 'poll']:
+            self._allow(request, 'GET')
+            return await self.poll(request)
+        if len(path) == 3 and path[0] == 'fireplaces':
+            unit = self._units.get(path[1])
+            if unit is None:
+                raise HttpError(404, 'Unknown fireplace {}'.format(path[1]))
+            if path[2] == 'state':
+                return await self.state(request, unit)
+            if path[2] in VALUE_FIELDS:
+                return await self.value(request, unit, path[2])
+        raise HttpError(404, 'Not found')
+
+    def _cache(self, unit):
+        return self._caches.get(self._keys[unit])
+
+    async def _read(self, function, *args):
+        """Call a function that reads the state, on the executor if reads block so the loop never waits on them"""
+        if not self._blocking_reads:
+            return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(function, *args))
+
+    @staticmethod
+    def _allow(request, *methods):
+        if request.method not in methods:
+            raise HttpError(405, 'Method not allowed')
+
+    async def _dispatch(self, request, future, queued):
+        """Answer 202 with the queued body right away when asked to, otherwise wait until the command is on air"""
+        if request.respond_async:
+            future.add_done_callback(_log_failure)
+            return queued
+        await future
+        return None
+
+    async def legacy_state(self, request, unit):
+        """Get the whole state, or set the pilot, power and flame from a JSON body, like server.py"""
+        self._allow(request, 'GET', 'PUT', 'PATCH')
+        if request.method == 'GET':
+            return Response.cached(request, await self._read(self._cache(unit).state), 'application/json')
+        if request.method == 'PATCH':
+            return await self.patch(request, unit)
+        value = request.json()
+        try:
+            values = {'pilot': value['pilot'], 'power': value['power'], 'flame': value['flame']}
+            future = unit.submit(turns_off(values), **values)
+        except (KeyError, TypeError, ValueError) as e:
+            raise HttpError(400, 'Bad state: {}'.format(e))
+        queued = await self._dispatch(request, future, Response.json(values, 202))
+        return queued or Response(str(await self._read(lambda: unit.fireplace.state)))
+
+    async def state(self, request, unit):
+        """Get or set the whole state of one fireplace as JSON"""
+        self._allow(request, 'GET', 'PUT', 'PATCH')
+        if request.method == 'GET':
+            return Response.cached(request, await self._read(self._cache(unit).state), 'application/json')
+        if request.method == 'PATCH':
+            return await self.patch(request, unit)
+        values = request.json()
+        try:
+            future = unit.submit(turns_off(values), **values)
+        except (AttributeError, TypeError, ValueError) as e:
+            raise HttpError(400, str(e))
+        queued = await self._dispatch(request, future, Response.json(values, 202))
+        return queued or Response.json(await self._read(lambda: unit.fireplace.state))
+
+    async def patch(self, request, unit):
+        """Check any subset of values from a JSON body, send them in one packet and return the new state as JSON"""
+        try:
+            values = json_values(request.json())
+        except ValueError as e:
+            raise HttpError(400, str(e))
+        future = unit.submit(turns_off(values), **values)
+        queued = await self._dispatch(request, future, Response.json(values, 202))
+        return queued or Response.json(await self._read(lambda: unit.fireplace.state))
+
+    async def value(self, request, unit, name):
+        """Get or set one value as plain text and return the status"""
+        self._allow(request, 'GET', 'PUT')
+        if request.method == 'PUT':
+            try:
+                value = parse_value(name, request.text())
+                future = unit.submit(turns_off({name: value}), **{name: value})
+            except ValueError as e:
+                raise HttpError(400, str(e))
+            queued = await self._dispatch(request, future, Response(str(value), 202))
+            return queued or Response(str(await self._read(getattr, unit.fireplace, name)))
+        return Response.cached(request, await self._read(self._cache(unit).value, name))
+
+    async def scene(self, request):
+        """Set values on several fireplaces at once, given as {id: {name: value}}, in one radio session"""
+        self._allow(request, 'PUT')
+        scene = request.json()
+        if not isinstance(scene, dict):
+            raise HttpError(400, 'Scene must be an object of fireplace ids')
+        missing = [key for key in scene if key not in self._units]
+        if missing:
+            raise HttpError(404, 'Unknown fireplaces {}'.format(missing))
+        try:
+            for values in scene.values():
+                validate(**values)
+        except (TypeError, ValueError) as e:
+            raise HttpError(400, str(e))
+        return await self.group(request, self._registry.scene, scene)
+
+    async def poll(self, request):
+        """Long poll for the state changes after the since event id, waiting up to timeout seconds for one"""
+        last = parse_event_id(request.query.get('since'))
+        try:
+            timeout = min(float(request.query.get('timeout', POLL_TIMEOUT)), POLL_TIMEOUT)
+        except ValueError:
+            raise HttpError(400, 'Bad timeout')
+        changes = await self._events.wait_async(last, timeout)
+        return Response(poll_json(changes, last), content_type='application/json')
+
+    async def group(self, request, function, *args):
+        """Run a registry group command on the radio executor"""
+        future = self._default.run(function, *args)
+        queued = await self._dispatch(request, future, Response.json(list(args[0]) if args else self._registry.ids(),
+                                                                     202))
+        if queued:
+            return queued
+        return Response.json(future.result())
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error('Queued command failed: {}'.format(future.exception()))
+
+
+def create_app():
+    """The app for the broker named by SMARTFIRE_BROKER, or for a radio opened as registry.from_environment says
+
+    Commands and state reads for the broker are forwarded from a thread pool, since they only wait on the socket."""
+    if os.environ.get('SMARTFIRE_BROKER'):
+        registry, events = connect(os.environ['SMARTFIRE_BROKER'])
+        return SmartfireApp(registry, ThreadPoolExecutor(thread_name_prefix='broker-client'), events,
+                            blocking_reads=True)
+    return SmartfireApp(from_environment())
+
+
+if __name__ == "__main__":
+    import uvicorn  # optional, only needed to serve this module directly
+
+    uvicorn.run(create_app(), host='0.0.0.0', port=5000)
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+"""
+batch.py: NumPy vectorized encoder for many fireplace states at once.
+
+Computes the same packets as codec.encode_packet, but for whole arrays of states and serial numbers, using array
+operations for the command bytes, ECC words, parity and Manchester expansion.
+"""
+
+import numpy as np
+
+from .codec import DEFAULT_ECC_CONSTANTS, MAX_LEVEL, PACKET_BYTES, WORDS
+
+# One fireplace state per record
+STATE_DTYPE = np.dtype([
+    ('pilot', np.bool_),
+    ('light', np.uint8),
+    ('thermostat', np.bool_),
+    ('power', np.bool_),
+    ('front', np.bool_),
+    ('fan', np.uint8),
+    ('aux', np.bool_),
+    ('flame', np.uint8),
+])
+
+# Symbol codes as their two Manchester bits: S=11, 1=10, 0=01, Z=00
+SYMBOL_SYNC = 0b11
+SYMBOL_ONE = 0b10
+SYMBOL_ZERO = 0b01
+
+# Bit positions of the 9 bit word, most significant first
+WORD_SHIFTS = np.arange(8, -1, -1, dtype=np.uint16)
+
+
+def states_array(states):
+    """Convert a sequence of state tuples, in STATE_DTYPE field order, to a structured state array"""
+    return np.array([tuple(s) for s in states], dtype=STATE_DTYPE)
+
+
+def serials_array(serials):
+    """Convert serial numbers as lists of 9 bit strings to an (N, 3) array of serial words"""
+    return np.array([[int(s, 2) if isinstance(s, str) else s for s in serial] for serial in serials],
+                    dtype=np.uint16)
+
+
+def command_bytes(states):
+    """Pack a state array into the two command data bytes, returned as two uint8 arrays"""
+    for field in ('light', 'fan', 'flame'):
+        if np.any(states[field] > MAX_LEVEL):
+            raise ValueError("{} values must be between 0 and 6 inclusive".format(field.capitalize()))
+    u8 = np.uint8
+    cmd1 = ((states['pilot'].astype(u8) << 7) | (states['light'].astype(u8) << 4)
+            | (states['thermostat'].astype(u8) << 1) | states['power'].astype(u8))
+    cmd2 = ((states['front'].astype(u8) << 7) | (states['fan'].astype(u8) << 4)
+            | (states['aux'].astype(u8) << 3) | states['flame'].astype(u8))
+    return cmd1, cmd2
+
+
+def ecc_bytes(command, c, d):
+    """Calculate the error detection bytes for an array of command bytes using the constants C and D"""
+    a = command >> 4
+    b = command & 0xF
+    high = (c ^ a ^ (a << 1) ^ (b << 1)) & 0xF
+    low = (d ^ a ^ b) & 0xF
+    return ((high << 4) | low).astype(np.uint8)
+
+
+def encode_batch(states, serials, ecc_constants=DEFAULT_ECC_CONSTANTS):
+    """Encode N states into an (N, 25) uint8 array of packets
+
+    states is a STATE_DTYPE array of shape (N,). serials is an (N, 3) array of 9 bit serial words, or a single
+    (3,) serial shared by every state."""
+    states = np.asarray(states, dtype=STATE_DTYPE)
+    n = states.shape[0]
+    serials = np.broadcast_to(np.asarray(serials, dtype=np.uint16), (n, 3))
+    (c1, d1), (c2, d2) = ecc_constants
+
+    # the 9 bit words: 3 serial words, then the command and ecc bytes followed by a zero padding bit
+    cmd1, cmd2 = command_bytes(states)
+    words = np.empty((n, WORDS), dtype=np.uint16)
+    words[:, 0:3] = serials
+    words[:, 3] = cmd1.astype(np.uint16) << 1
+    words[:, 4] = cmd2.astype(np.uint16) << 1
+    words[:, 5] = ecc_bytes(cmd1, c1, d1).astype(np.uint16) << 1
+    words[:, 6] = ecc_bytes(cmd2, c2, d2).astype(np.uint16) << 1
+
+    # expand to the 13 symbols of each word
+    bits = ((words[:, :, np.newaxis] >> WORD_SHIFTS) & 1).astype(np.uint8)
+    symbols = np.empty((n, WORDS, 13), dtype=np.uint8)
+    symbols[:, :, 0] = SYMBOL_SYNC
+    symbols[:, :, 1] = SYMBOL_ONE
+    symbols[:, :, 2:11] = SYMBOL_ZERO + bits  # 0 -> 01, 1 -> 10
+    symbols[:, :, 11] = SYMBOL_ZERO + (bits.sum(axis=2) & 1)  # parity over the data and padding bits
+    symbols[:, :, 12] = SYMBOL_ONE
+
+    # manchester expand each symbol into its two bits, then pack with the zero padding symbols at the end
+    encoded = np.zeros((n, PACKET_BYTES * 8), dtype=np.uint8)
+    flat = symbols.reshape(n, WORDS * 13)
+    encoded[:, 0:WORDS * 26:2] = flat >> 1
+    encoded[:, 1:WORDS * 26:2] = flat & 1
+    return np.packbits(encoded, axis=1)
@@ -0,0 +1,437 @@
+#!/usr/bin/python
+"""
+benchmark.py: Throughput and latency benchmarks for the fireplace encoders, decoders and radio paths.
+
+The radio benchmarks use the SimulatedBackend, so no transceiver is needed. Run with 'python benchmark.py [count]'.
+"""
+
+import random
+import sys
+import time
+
+if not __package__:
+    # run as a script, or imported from this directory, load the modules below as part of the package
+    import os
+    import sys
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = os.path.basename(os.path.dirname(os.path.abspath(__file__)))
+    __import__(__package__)
+
+from .codec import DEFAULT_ECC_CONSTANTS, FIELDS, encode_packet, serial_words, valid_command_bytes
+from .fireplace import DEFAULT_SERIAL, Fireplace
+from .state import FireplaceState
+
+# The packet example in the README, AM demodulated bits of a capture that ends before the last half symbol
+README_CAPTURE = ('111001011001011001101001101110011010101001100101101011100101010101011001011010111001100110010101'
+                  '1001101011101010100101011001010110111001010101011001010110101110011010011001101001101')
+README_COMMAND = (0x51, 0xE2)
+
+
+def random_states(count, seed=0):
+    """Generate random state tuples in STATE_DTYPE field order"""
+    rng = random.Random(seed)
+    return [(rng.random() < 0.5, rng.randint(0, 6), rng.random() < 0.5, rng.random() < 0.5,
+             rng.random() < 0.5, rng.randint(0, 6), rng.random() < 0.5, rng.randint(0, 6))
+            for _ in range(count)]
+
+
+def percentile(values, fraction):
+    """The value at the given fraction of the sorted values"""
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def report_latency(name, latencies, seconds):
+    print('{:<32} {:>6d} commands p50 {:>8.1f} ms p99 {:>8.1f} ms {:>8.1f} commands/s'.format(
+        name, len(latencies), percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+        len(latencies) / seconds))
+
+
+def report(name, count, seconds):
+    print('{:<32} {:>10d} packets {:>10.3f} ms {:>12.0f} packets/s'.format(
+        name, count, seconds * 1000, count / seconds if seconds else float('inf')))
+
+
+def reference_packet(serial, cmd1, cmd2, ecc_constants=DEFAULT_ECC_CONSTANTS):
+    """Encode a packet symbol by symbol, as the original bitstring based Fireplace.build_packet did"""
+    words = list(serial) + ['{:08b}0'.format(cmd1), '{:08b}0'.format(cmd2)]
+    for command, (c, d) in zip((cmd1, cmd2), ecc_constants):
+        high, low = command >> 4, command & 0xF
+        words.append('{:04b}{:04b}0'.format((c ^ high ^ (high << 1) ^ (low << 1)) & 0xF, high ^ low ^ d))
+    symbols = ''.join('S1{}{}1'.format(word, word.count('1') % 2) for word in words) + 'Z' * 9
+    bits = ''.join({'S': '11', '0': '01', '1': '10', 'Z': '00'}[symbol] for symbol in symbols)
+    return int(bits, 2).to_bytes(len(bits) // 8, 'big')
+
+
+def check_codec():
+    """Check the encoder against the README capture, and against the original encoder for every command"""
+    serial = serial_words(DEFAULT_SERIAL)
+    packet = encode_packet(serial, *README_COMMAND)
+    if '{:0200b}'.format(int.from_bytes(packet, 'big'))[:len(README_CAPTURE)] != README_CAPTURE:
+        raise AssertionError('Encoded packet differs from the README capture')
+    count = 0
+    for cmd1 in range(256):
+        for cmd2 in range(256):
+            if not valid_command_bytes(cmd1, cmd2):
+                continue
+            for ecc_constants in (DEFAULT_ECC_CONSTANTS, ((0x3, 0x5), (0x9, 0x2))):
+                if bytes(encode_packet(serial, cmd1, cmd2, ecc_constants)) != reference_packet(
+                        DEFAULT_SERIAL, cmd1, cmd2, ecc_constants):
+                    raise AssertionError('Packet for {:02x} {:02x} differs from the original encoder'.format(
+                        cmd1, cmd2))
+            count += 1
+    print('{:<32} {:>6d} commands match the original encoder and the README capture'.format('Codec', count))
+
+
+def bench_batch(count):
+    """Compare the vectorized batch encoder against looping the scalar build_packet"""
+    import numpy as np
+    from .batch import encode_batch, serials_array, states_array
+
+    states = random_states(count)
+    fp = Fireplace()
+
+    start = time.perf_counter()
+    scalar = []
+    for values in states:
+        fp._state = FireplaceState.from_values(*values)
+        scalar.append(bytes(fp.build_packet()))
+    report('Fireplace.build_packet', count, time.perf_counter() - start)
+
+    state_array = states_array(states)
+    serial = serials_array([fp.serial])[0]
+    start = time.perf_counter()
+    packets = encode_batch(state_array, serial)
+    report('batch.encode_batch', count, time.perf_counter() - start)
+
+    if not np.array_equal(packets, np.frombuffer(b''.join(scalar), dtype=np.uint8).reshape(count, -1)):
+        raise AssertionError('Batch encoder output differs from build_packet')
+
+
+def inject_errors(data, bit_error_rate, rng):
+    """Flip each bit of the data independently with the given probability"""
+    damaged = bytearray(data)
+    for i in range(len(damaged) * 8):
+        if rng.random() < bit_error_rate:
+            damaged[i // 8] ^= 0x80 >> (i % 8)
+    return damaged
+
+
+def bench_decoder(count, bit_error_rates=(0.0, 0.001, 0.005, 0.01, 0.02, 0.05)):
+    """Measure strict and tolerant packet recovery and decode throughput at several bit error rates"""
+    from .decoder import PacketDecoder
+
+    rng = random.Random(1)
+    fp = Fireplace()
+    bursts = []
+    for values in random_states(count):
+        fp._state = FireplaceState.from_values(*values)
+        packet = bytes(fp.build_packet())
+        # 5 copies per burst and a quiet gap between bursts, as they arrive from the receiver
+        bursts.append((values, packet * 5 + bytes(len(packet) * 2)))
+
+    for ber in bit_error_rates:
+        captures = [(values, inject_errors(burst, ber, rng)) for values, burst in bursts]
+        for tolerant in (False, True):
+            decoder = PacketDecoder(tolerant=tolerant, serial=fp.serial if tolerant else None)
+            recovered = 0
+            wrong = 0
+            confidence = 0.0
+            start = time.perf_counter()
+            for values, capture in captures:
+                packets = decoder.feed(capture) + decoder.flush()
+                for packet in packets:
+                    if packet.values == values and list(packet.serial) == fp.serial:
+                        recovered += 1
+                        confidence += packet.confidence
+                    else:
+                        wrong += 1
+                decoder.reset()
+            seconds = time.perf_counter() - start
+            print('{:<8} BER {:<6} recovered {:>6.1%} wrong {:>4d} mean confidence {:.3f} {:>8.0f} bursts/s'.format(
+                'tolerant' if tolerant else 'strict', ber, recovered / float(count), wrong,
+                confidence / recovered if recovered else 0.0, count / seconds))
+
+
+def bench_radio(count, time_scale=0.1):
+    """Measure command latency and throughput over the simulated radio, directly and through a worker
+
+    Simulated time is scaled down by time_scale to keep the run short and the results are scaled back up, which also
+    magnifies the Python overhead by 1 / time_scale."""
+    from .radio import SimulatedBackend
+    from .radio_worker import RadioWorker
+
+    states = random_states(count)
+
+    radio = SimulatedBackend(time_scale=time_scale)
+    radio.configure()
+    fp = Fireplace(radio=radio)
+    latencies = []
+    start = time.perf_counter()
+    for values in states:
+        begin = time.perf_counter()
+        fp.set(**dict(zip(FIELDS, values)))
+        latencies.append((time.perf_counter() - begin) / time_scale)
+    report_latency('Fireplace.set', latencies, (time.perf_counter() - start) / time_scale)
+
+    radio = SimulatedBackend(time_scale=time_scale)
+    radio.configure()
+    with RadioWorker(radio=radio) as worker:
+        fp = Fireplace(radio=radio, worker=worker)
+        latencies = []
+        start = time.perf_counter()
+        futures = [(time.perf_counter(), fp.set(**dict(zip(FIELDS, values)))) for values in states]
+        for begin, future in futures:
+            future.result()
+            latencies.append((time.perf_counter() - begin) / time_scale)
+        seconds = (time.perf_counter() - start) / time_scale
+    report_latency('RadioWorker, coalesced', latencies, seconds)
+    print('{:<32} {:>6d} bursts for {} commands'.format('', len(radio.bursts), count))
+
+
+def check_confirm(time_scale=0.01):
+    """Check confirmed sends against scripted echoes, with default and custom ECC, directly and through a worker
+
+    Each script lists, per burst, whether the fireplace hears it and echoes it back. The echo timeout and backoff are
+    shortened for the scripts, the Fireplace and RadioWorker paths are checked with the defaults and a prompt echo."""
+    from .codec import DEFAULT_ECC_CONSTANTS
+    from .confirm import MAX_RETRIES, send_confirmed
+    from .radio import SimulatedBackend
+    from .radio_worker import RadioWorker
+
+    scripts = [[True], [False, True], [False, False, True], [False] * (MAX_RETRIES + 1)]
+    checks = 0
+    for ecc_constants in (DEFAULT_ECC_CONSTANTS, ((0x3, 0x5), (0x9, 0x2))):
+        fp = Fireplace(ecc_constants=ecc_constants)
+        fp.update(power=True, flame=3)
+        packet = bytes(fp.build_packet())
+        for script in scripts:
+            radio = SimulatedBackend(echo_script=script, time_scale=time_scale)
+            delivery = send_confirmed(radio, packet, timeout=0.05, backoff=0.01, ecc_constants=ecc_constants)
+            if (delivery.confirmed, delivery.attempts, len(radio.bursts)) != (script[-1], len(script), len(script)):
+                raise AssertionError('Script {} with ecc {} gave {} in {} bursts'.format(
+                    script, ecc_constants, delivery, len(radio.bursts)))
+            checks += 1
+
+        for worker in (False, True):
+            radio = SimulatedBackend(time_scale=time_scale)
+            background = RadioWorker(radio=radio, confirm=True) if worker else None
+            fp = Fireplace(radio=radio, worker=background, confirm=True, ecc_constants=ecc_constants)
+            delivery = fp.set(power=True, flame=3)
+            if background is not None:
+                delivery = delivery.result()
+                background.close()
+            if not delivery.confirmed or delivery.attempts != 1 or fp.due():
+                raise AssertionError('Echo with ecc {}{} gave {}'.format(
+                    ecc_constants, ', worker' if worker else '', delivery))
+            checks += 1
+    print('{:<32} {:>6d} checks passed'.format('Confirmed sends', checks))
+
+
+def bench_packer(commands=(1, 2, 4, 8, 16), time_scale=0.1):
+    """Compare USB transfers and latency for N commands sent one at a time and packed into shared transfers"""
+    from .packer import transmit_packed
+    from .radio import SimulatedBackend, transmit
+
+    for count in commands:
+        packets = [bytes(Fireplace(serial=['{:09b}'.format(i << 1), '000000000', '000000000']).build_packet())
+                   for i in range(count)]
+        radio = SimulatedBackend(time_scale=time_scale)
+        start = time.perf_counter()
+        for packet in packets:
+            transmit(radio, packet)
+        single_seconds = (time.perf_counter() - start) / time_scale
+        single_transfers = radio.usb_transfers
+
+        radio = SimulatedBackend(time_scale=time_scale)
+        start = time.perf_counter()
+        transmit_packed(radio, packets)
+        packed_seconds = (time.perf_counter() - start) / time_scale
+        print('{:<32} {:>6d} commands {:>4d} -> {:>4d} transfers, {:>4d} saved {:>8.1f} -> {:>8.1f} ms'.format(
+            'Burst packer', count, single_transfers, radio.usb_transfers, single_transfers - radio.usb_transfers,
+            single_seconds * 1000, packed_seconds * 1000))
+
+
+def stress_fireplace(writers=8, readers=8, commands=50, worker=False, batch=False, seed=2):
+    """Hammer one Fireplace from many writer and reader threads and check that nothing torn goes on air or is read
+
+    Every transmitted packet must decode to one of the requested states, every snapshot read must be one of the
+    requested states or the initial one, and the last packet sent must match the final model. With batch the writers
+    apply each state one value at a time inside Fireplace.batch, so readers must never see the values in between."""
+    import threading
+
+    from .decoder import decode_packet
+    from .fireplace import INITIAL_STATE
+    from .radio import SimulatedBackend
+    from .radio_worker import RadioWorker
+
+    radio = SimulatedBackend(time_scale=0.0, echo=False)
+    background = RadioWorker(radio=radio) if worker else None
+    fp = Fireplace(radio=radio, worker=background)
+    requests = [[FireplaceState.from_values(*values) for values in random_states(commands, seed + i)]
+                for i in range(writers)]
+    requested = set(state for states in requests for state in states)
+    seen = []
+    stop = threading.Event()
+
+    def write(states):
+        for state in states:
+            if not batch:
+                fp.set(force=True, **state.as_dict())
+                continue
+            with fp.batch(force=True):
+                for name, value in state.as_dict().items():
+                    setattr(fp, name, value)
+
+    def read():
+        while not stop.is_set():
+            seen.append(fp.snapshot)
+            values = fp.state
+            seen.append(FireplaceState.from_values(**{name: values[name] for name in FIELDS}))
+            time.sleep(0)  # let the writers run
+
+    threads = [threading.Thread(target=write, args=(states,)) for states in requests]
+    watchers = [threading.Thread(target=read) for _ in range(readers)]
+    start = time.perf_counter()
+    for thread in watchers + threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stop.set()
+    for thread in watchers:
+        thread.join()
+    if background is not None:
+        background.close()
+    seconds = time.perf_counter() - start
+
+    sent = [decode_packet(burst.data).snapshot for burst in radio.bursts]
+    if not all(state in requested for state in sent):
+        raise AssertionError('A transmitted packet matches no requested state')
+    if not all(state in requested or state == INITIAL_STATE for state in seen):
+        raise AssertionError('A reader saw a state that was never requested')
+    if sent[-1] != fp.snapshot:
+        raise AssertionError('Last packet sent differs from the final state')
+    print('{:<32} {:>6d} sets {:>6d} sent {:>8d} reads {:>8.1f} ms'.format(
+        'Fireplace stress' + (', worker' if worker else '') + (', batch' if batch else ''), writers * commands,
+        len(sent), len(seen), seconds * 1000))
+
+
+def bench_journal(count, fireplaces=16):
+    """Measure the caller side cost of journaling states, the fsyncs group commit saves, and replay time"""
+    import shutil
+    import tempfile
+
+    from .journal import StateJournal
+
+    directory = tempfile.mkdtemp()
+    try:
+        units = [Fireplace(serial=['{:09b}'.format(i << 1), '000000000', '000000000']) for i in range(fireplaces)]
+        states = [FireplaceState.from_values(*values) for values in random_states(count)]
+        journal = StateJournal(directory, snapshot_every=max(count // 4, 1))
+        start = time.perf_counter()
+        for i, state in enumerate(states):
+            journal.record(units[i % fireplaces], state)
+        report('StateJournal.record', count, time.perf_counter() - start)
+        journal.flush()
+        stats = journal.stats
+        journal.close()
+        print('{:<32} {:>10d} records {:>6d} fsyncs {:>4d} snapshots'.format(
+            '', stats['records'], stats['syncs'], stats['snapshots']))
+
+        journal = StateJournal(directory)
+        start = time.perf_counter()
+        latest = journal.load()
+        print('{:<32} {:>10d} fireplaces {:>10.3f} ms'.format('StateJournal replay', len(latest),
+                                                            (time.perf_counter() - start) * 1000))
+        journal.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_asgi(count, concurrency=32, put_fraction=0.1, time_scale=0.01):
+    """Measure request latency through the ASGI app for a mix of GETs and PUTs answered with 202, in process"""
+    import asyncio
+
+    from .asgi import SmartfireApp
+    from .radio import SimulatedBackend
+    from .registry import FireplaceRegistry
+
+    registry = FireplaceRegistry(SimulatedBackend(time_scale=time_scale))
+    registry.create(None)
+    app = SmartfireApp(registry)
+    rng = random.Random(3)
+    requests = [('PUT', '/flame', str(rng.randint(0, 6)).encode()) if rng.random() < put_fraction
+                else ('GET', '/state', b'') for _ in range(count)]
+    latencies = []
+
+    async def call(method, path, body):
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            pass
+
+        scope = {'type': 'http', 'method': method, 'path': path, 'headers': [(b'prefer', b'respond-async')]}
+        begin = time.perf_counter()
+        await app(scope, receive, send)
+        latencies.append(time.perf_counter() - begin)
+
+    async def client(index):
+        for method, path, body in requests[index::concurrency]:
+            await call(method, path, body)
+
+    async def run():
+        await asyncio.gather(*[client(i) for i in range(concurrency)])
+
+    start = time.perf_counter()
+    asyncio.run(run())
+    report_latency('ASGI app, 202 PUTs', latencies, time.perf_counter() - start)
+
+
+def bench_pool(fireplaces=16, commands=2, radios=(1, 2, 4), time_scale=0.1):
+    """Measure aggregate command throughput for several fireplaces as simulated radios are added"""
+    from .radio import SimulatedBackend
+    from .radio_pool import RadioPool
+
+    for count in radios:
+        with RadioPool([SimulatedBackend(time_scale=time_scale) for _ in range(count)]) as pool:
+            units = [Fireplace(serial=['{:09b}'.format(i << 1), '000000000', '000000000'], worker=pool)
+                     for i in range(fireplaces)]
+            start = time.perf_counter()
+            futures = []
+            for level in range(commands):
+                # wait for each round so that the commands are not coalesced away
+                round_futures = [fp.set(flame=level) for fp in units]
+                for future in round_futures:
+                    future.result()
+                futures.extend(round_futures)
+            seconds = (time.perf_counter() - start) / time_scale
+        print('{:<32} {:>6d} radios {:>6d} commands {:>8.1f} commands/s'.format(
+            'RadioPool', count, len(futures), len(futures) / seconds))
+
+
+def run_checks():
+    """The correctness checks alone, without the benchmarks, for 'python benchmark.py check'"""
+    check_codec()
+    check_confirm()
+    for worker in (False, True):
+        for batch in (False, True):
+            stress_fireplace(worker=worker, batch=batch)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ['check']:
+        run_checks()
+        sys.exit()
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    bench_batch(count)
+    bench_decoder(max(count // 100, 10))
+    bench_radio(max(count // 100, 10))
+    bench_packer()
+    bench_journal(count)
+    bench_asgi(count)
+    bench_pool()
+    run_checks()
@@ -0,0 +1,356 @@
+#!/usr/bin/python
+"""
+broker.py: One process owning the radio and the fireplace state, shared by any number of HTTP workers.
+
+The RfCat dongle can only be opened once, so under a multi worker HTTP server exactly one broker process holds the
+FireplaceRegistry and its radio, and the workers reach it over a local Unix socket. Each request and reply is one line
+of JSON. RemoteRegistry, RemoteFireplace and RemoteEvents give the workers the same interface as the local classes, so
+the servers run unchanged on either, see server.create_app and asgi.create_app.
+
+Run the broker with 'python broker.py [socket]', configured like the servers with registry.from_environment, then
+point the workers at it with SMARTFIRE_BROKER=socket. Without a path it uses SMARTFIRE_BROKER, or DEFAULT_SOCKET as
+smartfire.service does. It keeps the radio open between commands, so it is also the daemon behind the cli.py command
+line client. The socket is open to the broker's group, smartfire under systemd.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+
+if not __package__:
+    # run as a script, or imported from this directory, load the modules below as part of the package
+    import os
+    import sys
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = os.path.basename(os.path.dirname(os.path.abspath(__file__)))
+    __import__(__package__)
+
+from .cli import DEFAULT_SOCKET
+from .events import StateEvents, parse_event_id
+from .fireplace import validate
+from .registry import from_environment
+from .state import FireplaceState
+
+# Seconds a client waits for a reply, on top of any wait it asked for, a confirmed send may retry for several seconds
+CALL_TIMEOUT = 30.0
+
+
+class BrokerError(Exception):
+    """A request the broker refused, with the HTTP status that fits it"""
+
+    def __init__(self, status, message):
+        super(BrokerError, self).__init__(message)
+        self.status = status
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                reply = {'ok': True, 'result': self.server.broker.handle(request)}
+            except BrokerError as e:
+                reply = {'ok': False, 'status': e.status, 'error': str(e)}
+            except (KeyError, TypeError, ValueError) as e:
+                reply = {'ok': False, 'status': 400, 'error': str(e)}
+            except Exception as e:
+                logging.exception('Broker request failed')
+                reply = {'ok': False, 'status': 500, 'error': str(e)}
+            self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128  # every event stream of every worker connects for each wait
+
+
+class Broker(object):
+    """Serves a FireplaceRegistry over a Unix socket, sending one command at a time over its radio"""
+
+    def __init__(self, registry, path=DEFAULT_SOCKET):
+        self._registry = registry
+        self._events = StateEvents(registry)
+        self._radio_lock = threading.Lock()  # connections have their own threads, the radio takes one command
+        self._path = path
+        if os.path.exists(path):
+            os.unlink(path)  # left over from a broker that did not shut down
+        self._server = _Server(path, _Handler)
+        self._server.broker = self
+        os.chmod(path, 0o660)  # owner and group, the clients join the broker's group
+
+    def _fireplace(self, key):
+        if key is None:
+            key = self._registry.ids()[0]  # the first fireplace, like the unscoped HTTP routes
+        if key not in self._registry:
+            raise BrokerError(404, 'Unknown fireplace {}'.format(key))
+        return self._registry.get(key)
+
+    def handle(self, request):
+        """Carry out one request and return its result"""
+        op = request['op']
+        if op == 'fireplaces':
+            return [[key, self._registry.get(key).serial] for key in self._registry.ids()]
+        if op == 'snapshot':
+            return self._fireplace(request.get('id')).snapshot.bits
+        if op == 'set':
+            fireplace = self._fireplace(request.get('id'))
+            with self._radio_lock:
+                fireplace.set(force=request.get('force', False), **request['values'])
+            return fireplace.snapshot.bits
+        if op == 'scene':
+            for key in request['scene']:
+                self._fireplace(key)
+            with self._radio_lock:
+                return self._registry.scene(request['scene'], request.get('force', False))
+        if op == 'off':
+            with self._radio_lock:
+                return self._registry.all_off(request.get('force', False))
+        if op == 'stats':
+            return self._registry.stats
+        if op == 'events':
+            events = self._events.wait(parse_event_id(request.get('since')), min(request.get('timeout', 0), 60))
+            return [[str(last), key, state.bits] for last, key, state in events]
+        raise BrokerError(400, 'Unknown operation {}'.format(op))
+
+    def serve_forever(self):
+        logging.info('Broker listening on {}'.format(self._path))
+        self._server.serve_forever()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+
+
+class BrokerClient(object):
+    """Connection to a Broker, one socket per thread so that concurrent requests do not wait on each other"""
+
+    def __init__(self, path=DEFAULT_SOCKET, timeout=CALL_TIMEOUT):
+        self._path = path
+        self._timeout = timeout
+        self._local = threading.local()
+
+    @property
+    def path(self):
+        return self._path
+
+    def timeout(self, arguments):
+        """Seconds to wait for the reply to a request with the given arguments"""
+        return self._timeout + arguments.get('timeout', 0)
+
+    @staticmethod
+    def encode(op, arguments):
+        arguments['op'] = op
+        return json.dumps(arguments).encode('utf-8') + b'\n'
+
+    @staticmethod
+    def result(line):
+        """The result from a reply line, raising BrokerError if the broker refused the request"""
+        reply = json.loads(line.decode('utf-8'))
+        if not reply['ok']:
+            raise BrokerError(reply['status'], reply['error'])
+        return reply['result']
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self._path)
+            connection = self._local.connection = (sock, sock.makefile('rb'))
+        return connection
+
+    def _disconnect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection[1].close()
+            connection[0].close()
+            self._local.connection = None
+
+    def call(self, op, **arguments):
+        """Send one request and return its result, raising BrokerError if the broker refused it
+
+        Raises socket.timeout if the reply takes too long, the request is not repeated since it may still be carried
+        out. A connection the broker closed is opened again and the request repeated once."""
+        timeout = self.timeout(arguments)
+        data = self.encode(op, arguments)
+        for attempt in (1, 2):
+            try:
+                sock, reader = self._connection()
+                sock.settimeout(timeout)
+                sock.sendall(data)
+                line = reader.readline()
+                if line:
+                    break
+                raise ConnectionError('Broker closed the connection')
+            except socket.timeout:
+                self._disconnect()  # a late reply would answer the next request
+                raise
+            except (OSError, ConnectionError):
+                self._disconnect()
+                if attempt == 2:
+                    raise
+        return self.result(line)
+
+
+def _remote_field(name):
+    return property(lambda self: getattr(self.snapshot, name),
+                    lambda self, value: self.set(**{name: value}))
+
+
+class RemoteFireplace(object):
+    """A fireplace held by the broker, with the Fireplace properties the servers use"""
+
+    def __init__(self, client, key, serial):
+        self._client = client
+        self._key = key
+        self._serial = serial
+
+    @property
+    def serial(self):
+        return self._serial
+
+    @property
+    def snapshot(self):
+        return FireplaceState(self._client.call('snapshot', id=self._key))
+
+    @property
+    def state(self):
+        values = self.snapshot.as_dict()
+        values['serial'] = self._serial
+        return values
+
+    pilot = _remote_field('pilot')
+    light = _remote_field('light')
+    thermostat = _remote_field('thermostat')
+    power = _remote_field('power')
+    front = _remote_field('front')
+    fan = _remote_field('fan')
+    aux = _remote_field('aux')
+    flame = _remote_field('flame')
+
+    def set(self, force=False, **values):
+        """Have the broker change the values and transmit, returns once it is on air"""
+        validate(**values)
+        values = {name: value for name, value in values.items() if value is not None}
+        try:
+            self._client.call('set', id=self._key, values=values, force=force)
+        except BrokerError as e:
+            if e.status == 400:
+                raise ValueError(str(e))
+            raise
+
+
+class RemoteRegistry(object):
+    """The broker's FireplaceRegistry, with the registry interface the servers use"""
+
+    def __init__(self, client):
+        self._client = client
+        self._fireplaces = {}
+        self._ids = []
+        for key, serial in client.call('fireplaces'):
+            self._ids.append(key)
+            self._fireplaces[key] = RemoteFireplace(client, key, serial)
+
+    def get(self, key):
+        return self._fireplaces[key]
+
+    def ids(self):
+        return list(self._ids)
+
+    def __contains__(self, key):
+        return key in self._fireplaces
+
+    def __iter__(self):
+        return iter([self._fireplaces[key] for key in self._ids])
+
+    def __len__(self):
+        return len(self._ids)
+
+    def scene(self, scene, force=False):
+        try:
+            return self._client.call('scene', scene=scene, force=force)
+        except BrokerError as e:
+            if e.status == 400:
+                raise ValueError(str(e))
+            raise
+
+    def set_group(self, ids, force=False, **values):
+        return self.scene({key: values for key in ids}, force)
+
+    def all_off(self, force=False):
+        return self._client.call('off', force=force)
+
+    @property
+    def stats(self):
+        return self._client.call('stats')
+
+
+class RemoteEvents(object):
+    """The broker's StateEvents, with the interface the servers use"""
+
+    def __init__(self, client):
+        self._client = client
+
+    def since(self, last):
+        return self.wait(last, 0)
+
+    @staticmethod
+    def _events(result):
+        return [(parse_event_id(last), key, FireplaceState(bits)) for last, key, bits in result]
+
+    def wait(self, last, timeout):
+        return self._events(self._client.call('events', since=None if last is None else str(last), timeout=timeout))
+
+    async def wait_async(self, last, timeout):
+        """Like wait, on a connection of its own read with asyncio, so no thread is held while it waits"""
+        arguments = {'since': None if last is None else str(last), 'timeout': timeout}
+        reader, writer = await asyncio.open_unix_connection(self._client.path)
+        try:
+            writer.write(self._client.encode('events', dict(arguments)))
+            line = await asyncio.wait_for(reader.readline(), self._client.timeout(arguments))
+        finally:
+            writer.close()
+        if not line:
+            raise ConnectionError('Broker closed the connection')
+        return self._events(self._client.result(line))
+
+
+def socket_path():
+    """The broker socket, from SMARTFIRE_BROKER or DEFAULT_SOCKET"""
+    return os.environ.get('SMARTFIRE_BROKER') or DEFAULT_SOCKET
+
+
+def connect(path=None):
+    """Remote registry and events for the broker at the path, from SMARTFIRE_BROKER or DEFAULT_SOCKET if not given"""
+    client = BrokerClient(path or socket_path())
+    return RemoteRegistry(client), RemoteEvents(client)
+
+
+def _terminate(signum, frame):
+    # systemd stops the service with SIGTERM, unwind serve_forever like Ctrl-C so the journal is written out
+    raise SystemExit(0)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    registry = from_environment()
+    broker = Broker(registry, sys.argv[1] if len(sys.argv) > 1 else socket_path())
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.close()
+        if registry.journal is not None:
+            registry.journal.close()
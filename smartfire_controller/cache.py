@@ -0,0 +1,96 @@
+#!/usr/bin/python
+"""
+cache.py: Pre-encoded GET response bodies for the fireplace state.
+
+A response body depends only on the immutable FireplaceState, so each fireplace keeps the bodies for its current state
+encoded once, and a GET compares the snapshot with the cached one and serves the same bytes until a change goes
+through. The ETag is the state itself, so it stays valid across restarts, and a client sending it back in
+If-None-Match gets a 304 with no body at all.
+"""
+
+import json
+import threading
+
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header value names the ETag, weak or strong, or is '*'"""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*' or tag == etag or (tag.startswith('W/') and tag[2:] == etag):
+            return True
+    return False
+
+
+class CachedState(object):
+    """The encoded responses for one state of one fireplace"""
+    __slots__ = ('state', 'version', 'etag', 'body', 'values')
+
+    def __init__(self, fireplace, state, version):
+        self.state = state
+        self.version = version  # times the cache was regenerated, for diagnostics
+        self.etag = '"{:04x}"'.format(state.bits)
+        values = state.as_dict()
+        values['serial'] = fireplace.serial
+        self.body = json.dumps(values).encode('utf-8')
+        # per value routes, tagged by the value alone so unrelated changes still match
+        self.values = {name: ('"{}"'.format(value), str(value).encode('utf-8')) for name, value in values.items()}
+
+
+class ResponseCache(object):
+    """Pre-encoded state responses for a fireplace, regenerated only after its state changes"""
+
+    def __init__(self, fireplace):
+        self._fireplace = fireplace
+        self._lock = threading.Lock()
+        self._entry = CachedState(fireplace, fireplace.snapshot, 0)
+        self.hits = 0
+        self.misses = 0
+
+    def current(self):
+        """The CachedState for the fireplace's current state"""
+        entry = self._entry
+        state = self._fireplace.snapshot
+        if entry.state == state:
+            self.hits += 1
+            return entry
+        with self._lock:
+            entry = self._entry
+            if entry.state != state:
+                self.misses += 1
+                entry = self._entry = CachedState(self._fireplace, state, entry.version + 1)
+            return entry
+
+    def state(self):
+        """(etag, body) of the whole state as JSON"""
+        entry = self.current()
+        return entry.etag, entry.body
+
+    def value(self, name):
+        """(etag, body) of one value as plain text"""
+        return self.current().values[name]
+
+
+class RegistryCache(object):
+    """Response caches for every fireplace in a registry, plus the combined list of their states"""
+
+    def __init__(self, registry):
+        self._registry = registry
+        self._caches = {key: ResponseCache(registry.get(key)) for key in registry.ids()}
+        self._list = (None, None, None)  # (states, etag, body)
+
+    def get(self, key):
+        return self._caches[key]
+
+    def all(self):
+        """(etag, body) of every fireplace's state by id, as served by GET /fireplaces"""
+        states = tuple(self._caches[key].current() for key in self._registry.ids())
+        cached = self._list
+        if cached[0] is not None and all(a is b for a, b in zip(cached[0], states)):
+            return cached[1], cached[2]
+        body = b'{' + b', '.join(json.dumps(key).encode('utf-8') + b': ' + entry.body
+                                 for key, entry in zip(self._registry.ids(), states)) + b'}'
+        etag = '"{}"'.format('.'.join('{:04x}'.format(entry.state.bits) for entry in states))
+        self._list = (states, etag, body)
+        return etag, body
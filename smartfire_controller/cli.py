@@ -0,0 +1,143 @@
+#!/usr/bin/python
+"""
+cli.py: Command line client for the fireplace daemon.
+
+The daemon, broker.py, keeps the radio open, so a command from a shell script or cron job only costs starting this
+small script, which imports nothing but the standard library and the state model, and one request over the Unix
+socket. The socket is only open to root and the smartfire group, see smartfire.service.
+
+    python cli.py set --power on --flame 3
+    python cli.py --id 04b-0f4-006 set --light 2
+    python cli.py state
+    python cli.py off
+
+Turning a fireplace off is always transmitted, even when it is off already, as the handheld remote may have turned it
+on since.
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+
+if not __package__:
+    # run as a script, or imported from this directory, load the modules below as part of the package
+    import os
+    import sys
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = os.path.basename(os.path.dirname(os.path.abspath(__file__)))
+    __import__(__package__)
+
+from .codec import FIELDS
+from .state import BOOLEAN_FIELDS, FireplaceState, turns_off
+
+# Socket of the daemon, in the runtime directory systemd creates for smartfire.service
+DEFAULT_SOCKET = '/run/smartfire/broker.sock'
+
+
+def switch(text):
+    """Parse on/off, true/false, yes/no or 1/0"""
+    value = text.lower()
+    if value in ('on', 'true', 'yes', '1'):
+        return True
+    if value in ('off', 'false', 'no', '0'):
+        return False
+    raise argparse.ArgumentTypeError("expected on or off, not {!r}".format(text))
+
+
+def level(text):
+    """Parse a level from 0 to 6"""
+    try:
+        value = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a level from 0 to 6, not {!r}".format(text))
+    if not 0 <= value <= 6:
+        raise argparse.ArgumentTypeError("expected a level from 0 to 6, not {}".format(value))
+    return value
+
+
+def request(path, op, **arguments):
+    """Send one request to the daemon and return its result, raising RuntimeError if it refused"""
+    arguments['op'] = op
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(arguments).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as reader:
+            line = reader.readline()
+    finally:
+        sock.close()
+    if not line:
+        raise RuntimeError("Daemon closed the connection")
+    reply = json.loads(line.decode('utf-8'))
+    if not reply['ok']:
+        raise RuntimeError(reply['error'])
+    return reply['result']
+
+
+def state_values(bits):
+    """Decode the 16 bit state the daemon returns into the values by name"""
+    return FireplaceState(bits).as_dict()
+
+
+def add_value_arguments(parser):
+    """Add a typed --name option for each fireplace value"""
+    for name in FIELDS:
+        if name in BOOLEAN_FIELDS:
+            parser.add_argument('--' + name, type=switch, metavar='on|off')
+        else:
+            parser.add_argument('--' + name, type=level, metavar='0-6')
+
+
+def given_values(arguments):
+    """The values given on the command line by name"""
+    return {name: getattr(arguments, name) for name in FIELDS if getattr(arguments, name) is not None}
+
+
+def parser():
+    parser = argparse.ArgumentParser(description="Control fireplaces through the smartfire daemon")
+    parser.add_argument('--socket', default=os.environ.get('SMARTFIRE_BROKER', DEFAULT_SOCKET),
+                        help="daemon socket, from SMARTFIRE_BROKER or {} by default".format(DEFAULT_SOCKET))
+    parser.add_argument('--id', help="fireplace id, the first one by default, see the list command")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    command = commands.add_parser('set', help="change values and transmit them in one packet")
+    add_value_arguments(command)
+    command.add_argument('--force', action='store_true', help="transmit even if nothing changed")
+
+    commands.add_parser('state', help="print the current state")
+    commands.add_parser('list', help="list the fireplace ids")
+    commands.add_parser('off', help="turn every fireplace off, even those that seem off already")
+    commands.add_parser('stats', help="print the transmissions performed and avoided")
+    return parser
+
+
+def main(argv=None):
+    arguments = parser().parse_args(argv)
+    try:
+        if arguments.command == 'set':
+            values = given_values(arguments)
+            if not values and not arguments.force:
+                raise RuntimeError("Nothing to set, give at least one value")
+            result = state_values(request(arguments.socket, 'set', id=arguments.id, values=values,
+                                          force=arguments.force or turns_off(values)))
+        elif arguments.command == 'state':
+            result = state_values(request(arguments.socket, 'snapshot', id=arguments.id))
+        elif arguments.command == 'list':
+            result = dict(request(arguments.socket, 'fireplaces'))
+        elif arguments.command == 'off':
+            result = request(arguments.socket, 'off', force=True)
+        else:
+            result = request(arguments.socket, 'stats')
+    except (OSError, RuntimeError) as e:
+        print('error: {}'.format(e), file=sys.stderr)
+        return 1
+    print(json.dumps(result))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
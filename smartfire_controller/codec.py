@@ -0,0 +1,108 @@
+#!/usr/bin/python
+"""
+codec.py: Integer, table driven encoder for Proflame 2 command packets.
+
+Each 13 symbol word is 'S', a '1' start guard, 8 data bits, a padding bit, a parity bit, and a '1' end guard. With the
+extended Manchester codes (S=11, 1=10, 0=01, Z=00) every word becomes 26 bits on air, and the 7 words plus 9 zero
+padding symbols make a 200 bit, 25 byte packet.
+"""
+
+# Encoded packet size
+WORDS = 7
+WORD_BITS = 26  # 13 Manchester encoded symbols
+PADDING_BITS = 18  # 9 'Z' symbols
+PACKET_BITS = WORDS * WORD_BITS + PADDING_BITS
+PACKET_BYTES = PACKET_BITS // 8
+
+# ECC constants (C, D) for the first and second error detection words
+DEFAULT_ECC_CONSTANTS = ((0xD, 0x0), (0x0, 0x7))
+
+# Names of the fireplace state values, in the order used for state tuples
+FIELDS = ('pilot', 'light', 'thermostat', 'power', 'front', 'fan', 'aux', 'flame')
+
+# Maximum value of a 3 bit level field, 7 is not an allowed value
+MAX_LEVEL = 6
+
+# Manchester code for every byte, 0 -> 01 and 1 -> 10, most significant bit first
+MANCHESTER = tuple(
+    sum((0b10 if (b >> i) & 1 else 0b01) << (2 * i) for i in range(8))
+    for b in range(256)
+)
+
+# Parity of every 9 bit word, 1 if there are an odd number of ones
+PARITY = tuple(bin(w).count('1') & 1 for w in range(512))
+
+# Fixed symbols of a word: S (11), start guard 1 (10) and end guard 1 (10)
+WORD_FRAME = (0b11 << 24) | (0b10 << 22) | 0b10
+
+
+def serial_words(serial):
+    """Convert the serial number strings, including padding bits, to 9 bit integers"""
+    return tuple(int(s, 2) if isinstance(s, str) else int(s) for s in serial)
+
+
+def command_bytes(pilot, light, thermostat, power, front, fan, aux, flame):
+    """Pack the fireplace state into the data bytes of the two command words"""
+    if not (0 <= light <= MAX_LEVEL and 0 <= fan <= MAX_LEVEL and 0 <= flame <= MAX_LEVEL):
+        raise ValueError("Level values must be between 0 and 6 inclusive")
+    cmd1 = (bool(pilot) << 7) | (light << 4) | (bool(thermostat) << 1) | bool(power)
+    cmd2 = (bool(front) << 7) | (fan << 4) | (bool(aux) << 3) | flame
+    return cmd1, cmd2
+
+
+def decode_command_bytes(cmd1, cmd2):
+    """Unpack the two command data bytes into the fireplace state tuple
+
+    The tuple is in the order pilot, light, thermostat, power, front, fan, aux, flame."""
+    return (bool(cmd1 & 0x80), (cmd1 >> 4) & 0x7, bool(cmd1 & 0x02), bool(cmd1 & 0x01),
+            bool(cmd2 & 0x80), (cmd2 >> 4) & 0x7, bool(cmd2 & 0x08), cmd2 & 0x7)
+
+
+def valid_command_bytes(cmd1, cmd2):
+    """Check the reserved zero bits and level ranges of the command data bytes"""
+    return (cmd1 & 0x0C == 0 and (cmd1 >> 4) & 0x7 <= MAX_LEVEL and (cmd2 >> 4) & 0x7 <= MAX_LEVEL
+            and cmd2 & 0x7 <= MAX_LEVEL)
+
+
+def ecc_byte(command, c, d):
+    """Calculate the error detection byte for a command byte using the constants C and D"""
+    a = command >> 4
+    b = command & 0xF
+    high = (c ^ a ^ (a << 1) ^ (b << 1)) & 0xF
+    low = (d ^ a ^ b) & 0xF
+    return (high << 4) | low
+
+
+def encode_word(word):
+    """Manchester encode a 9 bit word (8 data bits and the padding bit) into its 26 bit framed form"""
+    pad = word & 1
+    parity = PARITY[word]
+    return (WORD_FRAME | (MANCHESTER[word >> 1] << 6) | ((0b10 if pad else 0b01) << 4)
+            | ((0b10 if parity else 0b01) << 2))
+
+
+def encode_packet(serial, cmd1, cmd2, ecc_constants=DEFAULT_ECC_CONSTANTS, out=None):
+    """Encode a packet into the out buffer, or a new bytearray, and return the buffer
+
+    serial is a sequence of three 9 bit serial words and cmd1 and cmd2 are the command data bytes."""
+    if out is None:
+        out = bytearray(PACKET_BYTES)
+    (c1, d1), (c2, d2) = ecc_constants
+    words = (serial[0], serial[1], serial[2], cmd1 << 1, cmd2 << 1, ecc_byte(cmd1, c1, d1) << 1,
+             ecc_byte(cmd2, c2, d2) << 1)
+    acc = 0
+    bits = 0
+    pos = 0
+    for word in words:
+        acc = (acc << WORD_BITS) | encode_word(word)
+        bits += WORD_BITS
+        while bits >= 8:
+            bits -= 8
+            out[pos] = (acc >> bits) & 0xFF
+            pos += 1
+        acc &= (1 << bits) - 1
+    # flush the remaining bits, followed by the zero padding symbols
+    out[pos] = (acc << (8 - bits)) & 0xFF
+    for i in range(pos + 1, PACKET_BYTES):
+        out[i] = 0
+    return out
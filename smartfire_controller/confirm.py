@@ -0,0 +1,71 @@
+#!/usr/bin/python
+"""
+confirm.py: Acknowledged transmission using the fireplace's echo.
+
+The fireplace echoes every command it receives back exactly. After each burst the radio switches to receive and listens
+for the echo, and the burst is only sent again, after a growing backoff, when no matching echo arrives in time. The echo
+is checked with the fireplace's own ECC constants.
+
+The echo has only been checked with the SimulatedBackend so far, not with a fireplace and an RfCat dongle, so
+Fireplace and RadioWorker send without confirmation unless confirm is set.
+"""
+
+import logging
+import time
+from collections import namedtuple
+
+from .codec import DEFAULT_ECC_CONSTANTS
+from .decoder import PacketDecoder, decode_packet
+from .radio import transmit
+
+# Seconds to listen for the echo after each burst
+ECHO_TIMEOUT = 1.0
+
+# Retransmissions after the first burst, and the backoff before the first of them, doubling after each
+MAX_RETRIES = 3
+BACKOFF = 0.25
+
+Delivery = namedtuple('Delivery', 'confirmed attempts latency')
+
+
+def wait_for_echo(radio, expected, timeout=ECHO_TIMEOUT, ecc_constants=DEFAULT_ECC_CONSTANTS):
+    """Listen until the expected DecodedPacket is received, returning False if the timeout passes first"""
+    decoder = PacketDecoder(ecc_constants, tolerant=True, serial=expected.serial)
+    radio.listen()
+    deadline = time.time() + timeout
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        data = radio.receive(remaining)
+        if data is None:
+            continue
+        if any(p.words == expected.words for p in decoder.feed(data)):
+            return True
+    return any(p.words == expected.words for p in decoder.flush())
+
+
+def send_confirmed(radio, packet, timeout=ECHO_TIMEOUT, retries=MAX_RETRIES, backoff=BACKOFF,
+                   ecc_constants=DEFAULT_ECC_CONSTANTS):
+    """Transmit the packet until the fireplace echoes it back, and return the Delivery
+
+    The ecc_constants must be the ones the packet was encoded with."""
+    expected = decode_packet(packet, ecc_constants)
+    if expected is None:
+        raise ValueError("Packet does not decode with ecc constants {}".format(ecc_constants))
+    start = time.time()
+    attempt = 0
+    while True:
+        attempt += 1
+        with radio.session():  # no other burst between this one and its echo
+            transmit(radio, packet)
+            heard = wait_for_echo(radio, expected, timeout, ecc_constants)
+        if heard:
+            latency = time.time() - start
+            logging.info('Confirmed after {} attempts in {:.3f}s'.format(attempt, latency))
+            return Delivery(True, attempt, latency)
+        if attempt > retries:
+            break
+        time.sleep(backoff * 2 ** (attempt - 1))
+    logging.warning('No echo after {} attempts'.format(attempt))
+    return Delivery(False, attempt, time.time() - start)
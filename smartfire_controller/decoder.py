@@ -0,0 +1,377 @@
+#!/usr/bin/python
+"""
+decoder.py: Streaming decoder for received Proflame 2 command bursts.
+
+Raw demodulated bytes are shifted one bit at a time through a window the size of one encoded packet. Whenever the
+sync symbols and guard bits of all 7 words line up, the window is Manchester decoded and checked for parity, padding,
+command ranges and both error detection words. The 5 repeated copies of a packet in one burst produce a single
+decoded packet. In tolerant mode damaged copies are majority voted and corrected with the parity and error detection
+redundancy.
+"""
+
+import logging
+from collections import namedtuple
+
+if not __package__:
+    # run as a script, or imported from this directory, load the modules below as part of the package
+    import os
+    import sys
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = os.path.basename(os.path.dirname(os.path.abspath(__file__)))
+    __import__(__package__)
+
+from .codec import (DEFAULT_ECC_CONSTANTS, FIELDS, MANCHESTER, PARITY, PACKET_BITS, WORD_BITS, WORD_FRAME,
+                   WORDS, decode_command_bytes, ecc_byte, valid_command_bytes)
+from .state import FireplaceState
+
+# Bits of one packet without the trailing zero padding
+FRAME_BITS = WORDS * WORD_BITS
+FRAME_MASK_BITS = (1 << FRAME_BITS) - 1
+
+# Sync and guard bits of every word in the frame window
+FRAME_MASK = 0
+FRAME_VALUE = 0
+for _word in range(WORDS):
+    FRAME_MASK |= ((0b11 << 24) | (0b11 << 22) | 0b11) << (_word * WORD_BITS)
+    FRAME_VALUE |= WORD_FRAME << (_word * WORD_BITS)
+
+# Copies of a packet in one burst
+BURST_COPIES = 5
+
+# A copy of the same packet starting within this many bits of the last one is a repeat within the same burst
+REPEAT_WINDOW_BITS = BURST_COPIES * PACKET_BITS
+
+# A burst has ended when no frame has been seen for this many bits
+BURST_GAP_BITS = 2 * PACKET_BITS
+
+# Tolerant decoding limits: bad sync or guard bits for a window to count as a frame, erased symbols per word, and
+# damaged copies kept per burst
+MAX_FRAME_ERRORS = 4
+MAX_ERASURES = 3
+MAX_BURST_COPIES = BURST_COPIES
+
+# Confidence reduction for each symbol corrected by parity or error detection
+CORRECTION_PENALTY = 0.1
+
+# Byte for each valid 16 bit Manchester code
+MANCHESTER_DECODE = {code: byte for byte, code in enumerate(MANCHESTER)}
+
+# Single bit Manchester codes
+BIT_DECODE = {0b01: 0, 0b10: 1}
+
+
+class DecodedPacket(namedtuple('DecodedPacket', 'serial command1 command2 ecc1 ecc2 confidence')):
+    """A decoded packet: the three serial words as 9 bit strings, the command and ecc data bytes, and the confidence
+
+    Confidence is 1.0 for a packet that decoded without errors, and lower for one recovered by voting or correction."""
+    __slots__ = ()
+
+    def __new__(cls, serial, command1, command2, ecc1, ecc2, confidence=1.0):
+        return super(DecodedPacket, cls).__new__(cls, serial, command1, command2, ecc1, ecc2, confidence)
+
+    @property
+    def words(self):
+        """The decoded words, without the confidence, for comparing copies of the same packet"""
+        return self[:5]
+
+    @property
+    def values(self):
+        """The state tuple in the order pilot, light, thermostat, power, front, fan, aux, flame"""
+        return decode_command_bytes(self.command1, self.command2)
+
+    @property
+    def state(self):
+        return dict(zip(FIELDS, self.values), serial=list(self.serial))
+
+    @property
+    def snapshot(self):
+        """The received state as a FireplaceState, comparable with Fireplace.snapshot"""
+        return FireplaceState.from_bytes(self.command1, self.command2)
+
+
+def decode_word(bits):
+    """Decode a 26 bit framed word into its 9 bit value, or None if a symbol or the parity is invalid"""
+    data = MANCHESTER_DECODE.get((bits >> 6) & 0xFFFF)
+    pad = BIT_DECODE.get((bits >> 4) & 0b11)
+    parity = BIT_DECODE.get((bits >> 2) & 0b11)
+    if data is None or pad is None or parity is None:
+        return None
+    word = (data << 1) | pad
+    if PARITY[word] != parity:
+        return None
+    return word
+
+
+def decode_frame(frame, ecc_constants=DEFAULT_ECC_CONSTANTS, check_ecc=True):
+    """Decode the 182 bit frame of one packet, returning a DecodedPacket or None if it is invalid
+
+    The frame must already have valid sync and guard bits."""
+    words = []
+    for shift in range((WORDS - 1) * WORD_BITS, -1, -WORD_BITS):
+        word = decode_word((frame >> shift) & ((1 << WORD_BITS) - 1))
+        if word is None:
+            return None
+        words.append(word)
+    if any(w & 1 for w in words[3:]):  # padding bit is zero after the serial words
+        return None
+    cmd1, cmd2, ecc1, ecc2 = (w >> 1 for w in words[3:])
+    if not valid_command_bytes(cmd1, cmd2):
+        return None
+    if check_ecc:
+        (c1, d1), (c2, d2) = ecc_constants
+        if ecc1 != ecc_byte(cmd1, c1, d1) or ecc2 != ecc_byte(cmd2, c2, d2):
+            return None
+    return DecodedPacket(tuple('{:09b}'.format(w) for w in words[:3]), cmd1, cmd2, ecc1, ecc2)
+
+
+def decode_packet(packet, ecc_constants=DEFAULT_ECC_CONSTANTS):
+    """Decode the bytes of a single encoded packet, as built by Fireplace.build_packet"""
+    frame = int.from_bytes(bytes(packet), 'big') >> (len(packet) * 8 - FRAME_BITS)
+    return decode_frame(frame, ecc_constants)
+
+
+def frame_errors(frame):
+    """Count the sync and guard bits of a frame window that do not have their expected values"""
+    return bin((frame & FRAME_MASK) ^ FRAME_VALUE).count('1')
+
+
+def vote(frames):
+    """Majority vote each bit across copies of a frame
+
+    Returns the voted frame, a mask of the bits that tied, and the mean fraction of copies agreeing with each bit."""
+    voted = 0
+    ties = 0
+    agreeing = 0
+    copies = len(frames)
+    for bit in range(FRAME_BITS):
+        ones = sum((frame >> bit) & 1 for frame in frames)
+        if ones * 2 > copies:
+            voted |= 1 << bit
+        elif ones * 2 == copies:
+            ties |= 1 << bit
+        agreeing += max(ones, copies - ones)
+    return voted, ties, agreeing / float(FRAME_BITS * copies)
+
+
+def word_candidates(bits, ties=0):
+    """List the (9 bit word, corrections) pairs a damaged 26 bit framed word could have been
+
+    Symbols that are not valid Manchester codes, or have tied bits, are erasures and are filled in with every value
+    consistent with the parity. A word with no erasures but bad parity is assumed to have a single flipped symbol."""
+    symbols = []
+    erasures = []
+    for j in range(10):  # 8 data symbols, the padding symbol and the parity symbol
+        shift = 20 - 2 * j
+        value = BIT_DECODE.get((bits >> shift) & 0b11)
+        if value is None or (ties >> shift) & 0b11:
+            erasures.append(j)
+            value = 0
+        symbols.append(value)
+    if len(erasures) > MAX_ERASURES:
+        return []
+    candidates = []
+    for fill in range(1 << len(erasures)):
+        for i, j in enumerate(erasures):
+            symbols[j] = (fill >> i) & 1
+        word = 0
+        for value in symbols[:9]:
+            word = (word << 1) | value
+        if PARITY[word] == symbols[9]:
+            candidates.append((word, len(erasures)))
+    if not erasures and not candidates:
+        candidates = [(word ^ (1 << k), 1) for k in range(9)] + [(word, 1)]
+    return candidates
+
+
+def correct_frame(frame, ties=0, ecc_constants=DEFAULT_ECC_CONSTANTS, serial=None):
+    """Recover a packet from a damaged frame using parity and both error detection words
+
+    Returns (DecodedPacket, corrections), or None if the frame cannot be recovered unambiguously. Serial words have no
+    error detection of their own, so a damaged serial word is only recovered when the expected serial is given."""
+    candidates = []
+    for shift in range((WORDS - 1) * WORD_BITS, -1, -WORD_BITS):
+        candidates.append(word_candidates((frame >> shift) & ((1 << WORD_BITS) - 1),
+                                          (ties >> shift) & ((1 << WORD_BITS) - 1)))
+    corrections = 0
+    serial_words = []
+    for i, options in enumerate(candidates[:3]):
+        if serial is not None:
+            expected = int(serial[i], 2)
+            options = [o for o in options if o[0] == expected]
+        if len(options) != 1:
+            return None
+        serial_words.append(options[0][0])
+        corrections += options[0][1]
+    data = []
+    for (cmd_options, ecc_options), (c, d) in zip(((candidates[3], candidates[5]), (candidates[4], candidates[6])),
+                                                   ecc_constants):
+        matches = set()
+        for cmd, cmd_corrections in cmd_options:
+            for ecc, ecc_corrections in ecc_options:
+                if cmd & 1 or ecc & 1 or ecc >> 1 != ecc_byte(cmd >> 1, c, d):
+                    continue
+                matches.add((cmd_corrections + ecc_corrections, cmd >> 1, ecc >> 1))
+        if len(set(m[1] for m in matches)) != 1:
+            return None
+        best = min(matches)
+        corrections += best[0]
+        data.append(best[1:])
+    (cmd1, ecc1), (cmd2, ecc2) = data
+    if not valid_command_bytes(cmd1, cmd2):
+        return None
+    return DecodedPacket(tuple('{:09b}'.format(w) for w in serial_words), cmd1, cmd2, ecc1, ecc2), corrections
+
+
+def correct_burst(frames, ecc_constants=DEFAULT_ECC_CONSTANTS, serial=None):
+    """Recover a packet from the copies of a frame received in one burst, or return None
+
+    The copies are majority voted bit by bit before correction. The confidence is the mean vote agreement, reduced
+    by CORRECTION_PENALTY for every corrected symbol."""
+    frame, ties, agreement = vote(frames)
+    result = correct_frame(frame, ties, ecc_constants, serial)
+    if result is None:
+        return None
+    packet, corrections = result
+    return packet._replace(confidence=agreement * (1 - CORRECTION_PENALTY) ** corrections)
+
+
+class PacketDecoder(object):
+    """Incremental decoder holding only the rolling bit window, and in tolerant mode one burst, between calls
+
+    In tolerant mode windows with up to max_frame_errors bad sync or guard bits are also treated as frames. A copy that
+    decodes cleanly is returned immediately, otherwise the damaged copies of a burst are collected and recovered with
+    correct_burst once the burst ends."""
+
+    def __init__(self, ecc_constants=DEFAULT_ECC_CONSTANTS, check_ecc=True, tolerant=False, serial=None,
+                 max_frame_errors=MAX_FRAME_ERRORS):
+        if tolerant and not check_ecc:
+            raise ValueError("Tolerant decoding requires the error detection words")
+        self._ecc_constants = ecc_constants
+        self._check_ecc = check_ecc
+        self._tolerant = tolerant
+        self._serial = serial
+        self._max_frame_errors = max_frame_errors
+        self._window = 0
+        self._position = 0  # total bits consumed
+        self._last_packet = None
+        self._last_position = None
+        self._candidate_position = None
+        self._candidate_errors = None
+        self._candidate_in_burst = False
+        self._burst = []  # damaged copies of the current burst
+        self._burst_start = None
+        self.frames = 0  # windows with valid sync and guard bits
+        self.rejected = 0  # framed windows, or bursts in tolerant mode, that failed decoding or checks
+        self.repeats = 0  # copies collapsed into an earlier packet of the same burst
+        self.recovered = 0  # packets recovered from damaged copies
+
+    def _accept(self, packet, start, packets):
+        """Return the packet unless it repeats the last one within the same burst"""
+        repeat = (self._last_packet is not None and packet.words == self._last_packet.words
+                  and start - self._last_position <= REPEAT_WINDOW_BITS)
+        self._last_packet = packet
+        self._last_position = self._position
+        if repeat:
+            self.repeats += 1
+        else:
+            packets.append(packet)
+
+    def _finish_burst(self, packets):
+        """Recover the packet from the damaged copies collected for the current burst"""
+        frames, self._burst = self._burst, []
+        packet = correct_burst(frames, self._ecc_constants, self._serial)
+        if packet is None:
+            self.rejected += 1
+            return
+        self.recovered += 1
+        self._accept(packet, self._burst_start, packets)
+
+    def feed(self, data):
+        """Consume a chunk of raw demodulated bytes and return a list of the packets completed by it"""
+        packets = []
+        window = self._window
+        tolerant = self._tolerant
+        for byte in bytearray(data):
+            for shift in range(7, -1, -1):
+                window = ((window << 1) | ((byte >> shift) & 1)) & FRAME_MASK_BITS
+                self._position += 1
+                if tolerant and self._burst and self._position - self._candidate_position > BURST_GAP_BITS:
+                    self._finish_burst(packets)
+                if (window & FRAME_MASK) == FRAME_VALUE:
+                    errors = 0
+                elif not tolerant:
+                    continue
+                else:
+                    errors = frame_errors(window)
+                    if errors > self._max_frame_errors:
+                        continue
+                if tolerant:
+                    # candidates overlapping the previous one are the same copy at different offsets, keep the best
+                    if (self._candidate_position is not None
+                            and self._position - self._candidate_position < FRAME_BITS):
+                        if errors >= self._candidate_errors:
+                            continue
+                        if self._candidate_in_burst:
+                            self._burst.pop()
+                    else:
+                        self.frames += 1
+                    self._candidate_position = self._position
+                    self._candidate_errors = errors
+                    self._candidate_in_burst = False
+                else:
+                    self.frames += 1
+                packet = decode_frame(window, self._ecc_constants, self._check_ecc) if errors == 0 else None
+                if packet is not None:
+                    self._burst = []
+                    self._accept(packet, self._position, packets)
+                elif not tolerant:
+                    self.rejected += 1
+                elif len(self._burst) < MAX_BURST_COPIES:
+                    if not self._burst:
+                        self._burst_start = self._position
+                    self._burst.append(window)
+                    self._candidate_in_burst = True
+        self._window = window
+        return packets
+
+    def flush(self):
+        """Finish any burst still being collected and return a list of the packets it produced"""
+        packets = []
+        if self._burst:
+            self._finish_burst(packets)
+        return packets
+
+    def reset(self):
+        """Discard the partial window and burst, e.g. after a gap in reception"""
+        self._window = 0
+        self._last_packet = None
+        self._candidate_position = None
+        self._burst = []
+
+
+def decode_stream(chunks, ecc_constants=DEFAULT_ECC_CONSTANTS, check_ecc=True, tolerant=False, serial=None):
+    """Generate decoded packets from an iterable of raw demodulated byte chunks"""
+    decoder = PacketDecoder(ecc_constants, check_ecc, tolerant, serial)
+    for chunk in chunks:
+        for packet in decoder.feed(chunk):
+            yield packet
+    for packet in decoder.flush():
+        yield packet
+
+
+def receive_chunks(radio):
+    """Generate raw chunks from a RadioBackend, switched to receive first, skipping receive timeouts"""
+    radio.listen()
+    while True:
+        data = radio.receive()
+        if data is not None:
+            yield data
+
+
+if __name__ == "__main__":
+    from .radio import open_radio
+
+    logging.basicConfig(level=logging.INFO)
+    for packet in decode_stream(receive_chunks(open_radio()), tolerant=True):
+        logging.info('Received {} with confidence {:.2f}'.format(packet.state, packet.confidence))
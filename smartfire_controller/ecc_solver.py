@@ -0,0 +1,181 @@
+#!/usr/bin/python
+"""
+ecc_solver.py: Recover the error detection constants C and D from captured Proflame 2 packets.
+
+For a single transmitter the constants follow from each capture, since X = C ^ f(A, B) and Z = D ^ A ^ B, so every
+candidate is checked against the whole corpus at once and the best agreeing pair wins. When captures from several
+transmitters are available, the constants of each one are then explained by searching formulas over the nibbles of
+the serial number, spread over a process pool.
+
+Run with 'python ecc_solver.py capture.hex [...]', where each line of a capture file is a hex dump from RFrecv.
+"""
+
+import binascii
+import itertools
+import logging
+import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+if not __package__:
+    # run as a script, or imported from this directory, load the modules below as part of the package
+    import os
+    import sys
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = os.path.basename(os.path.dirname(os.path.abspath(__file__)))
+    __import__(__package__)
+
+from .codec import serial_words
+from .decoder import decode_stream
+
+# Constants in the order they appear in ecc_constants: ((C1, D1), (C2, D2))
+TARGETS = ('C1', 'D1', 'C2', 'D2')
+
+# Serial formula search space: each of the 6 data nibbles of the serial is absent or included rotated left 0-3 bits
+SERIAL_NIBBLES = 6
+ROTATIONS = 4
+OPERATIONS = ('xor', 'add')
+
+# Formula combinations per process pool task
+SEARCH_CHUNK = 1024
+
+EccSolution = namedtuple('EccSolution', 'ecc_constants agreement captures')
+
+
+class EccFormula(namedtuple('EccFormula', 'target operation constant terms')):
+    """A constant computed from the serial number as constant (op) rotl(nibble_i, r_i) for each (i, r_i) term"""
+    __slots__ = ()
+
+    def evaluate(self, serial):
+        value = self.constant
+        nibbles = serial_nibbles(serial)
+        for index, rotation in self.terms:
+            term = rotate(nibbles[index], rotation)
+            value = value ^ term if self.operation == 'xor' else value + term
+        return value & 0xF
+
+    def __str__(self):
+        symbol = ' ^ ' if self.operation == 'xor' else ' + '
+        parts = ['0x{:X}'.format(self.constant)] + ['rotl(n{}, {})'.format(i, r) for i, r in self.terms]
+        return '{} = ({})'.format(self.target, symbol.join(parts)) + (' & 0xF' if self.operation == 'add' else '')
+
+
+def rotate(nibble, rotation):
+    """Rotate 4 bit nibbles left, works on ints and arrays"""
+    return ((nibble << rotation) | (nibble >> (4 - rotation))) & 0xF
+
+
+def serial_nibbles(serial):
+    """The high and low data nibbles of each serial word, padding bits excluded"""
+    nibbles = []
+    for word in serial_words(serial):
+        nibbles.extend([(word >> 5) & 0xF, (word >> 1) & 0xF])
+    return nibbles
+
+
+def solve_constants(packets):
+    """Find the constants that explain the most captures from a single transmitter
+
+    Every C and D is tried against every capture at once, C only affects the high ecc nibble and D the low one so
+    they are solved independently."""
+    cmd = np.array([[p.command1, p.command2] for p in packets], dtype=np.int16)
+    ecc = np.array([[p.ecc1, p.ecc2] for p in packets], dtype=np.int16)
+    if not len(cmd):
+        raise ValueError("No packets to solve")
+    a = cmd >> 4
+    b = cmd & 0xF
+    candidates = np.arange(16, dtype=np.int16)[:, np.newaxis, np.newaxis]
+    high_matches = ((candidates ^ a ^ (a << 1) ^ (b << 1)) & 0xF) == (ecc >> 4)
+    low_matches = ((candidates ^ a ^ b) & 0xF) == (ecc & 0xF)
+    high_counts = high_matches.sum(axis=1)  # (16, 2) captures agreeing with each candidate, for each ecc word
+    low_counts = low_matches.sum(axis=1)
+    c = high_counts.argmax(axis=0)
+    d = low_counts.argmax(axis=0)
+    agreement = float(min(high_counts[c, [0, 1]].min(), low_counts[d, [0, 1]].min())) / len(cmd)
+    return EccSolution(((int(c[0]), int(d[0])), (int(c[1]), int(d[1]))), agreement, len(cmd))
+
+
+def solve_corpus(packets):
+    """Group captured packets by serial number and solve the constants of each transmitter"""
+    by_serial = {}
+    for packet in packets:
+        by_serial.setdefault(tuple(packet.serial), []).append(packet)
+    return {serial: solve_constants(group) for serial, group in by_serial.items()}
+
+
+def _search_chunk(combinations, nibbles, targets):
+    """Check a chunk of term combinations against every serial, returning the consistent formulas"""
+    combinations = np.asarray(combinations, dtype=np.int8)  # (m, 6) rotation per nibble, -1 when absent
+    rotated = np.stack([rotate(nibbles, r) for r in range(ROTATIONS)])  # (4, serials, 6)
+    found = []
+    for operation in OPERATIONS:
+        combined = np.zeros((len(combinations), nibbles.shape[0]), dtype=np.int16)
+        for i in range(SERIAL_NIBBLES):
+            present = combinations[:, i] >= 0
+            term = rotated[np.maximum(combinations[:, i], 0), :, i] * present[:, np.newaxis]
+            combined = combined ^ term if operation == 'xor' else combined + term
+        for t, target in enumerate(TARGETS):
+            # the constant each serial would need, a formula fits when it is the same for all of them
+            if operation == 'xor':
+                needed = (targets[:, t] ^ combined) & 0xF
+            else:
+                needed = (targets[:, t] - combined) & 0xF
+            consistent = np.all(needed == needed[:, :1], axis=1)
+            for row in np.nonzero(consistent)[0]:
+                terms = tuple((i, int(r)) for i, r in enumerate(combinations[row]) if r >= 0)
+                found.append(EccFormula(target, operation, int(needed[row, 0]), terms))
+    return found
+
+
+def search_formulas(solutions, processes=None):
+    """Search serial number formulas that explain the constants solved for several transmitters
+
+    Returns a dict from target name to the consistent formulas, simplest first. With fewer transmitters than terms
+    many formulas fit, so more captured remotes narrow the result."""
+    serials = sorted(solutions)
+    if len(serials) < 2:
+        logging.warning('Serial formulas need captures from at least two transmitters')
+    nibbles = np.array([serial_nibbles(s) for s in serials], dtype=np.int16)
+    targets = np.array([[c for pair in solutions[s].ecc_constants for c in pair] for s in serials], dtype=np.int16)
+    combinations = list(itertools.product(range(-1, ROTATIONS), repeat=SERIAL_NIBBLES))
+    chunks = [combinations[i:i + SEARCH_CHUNK] for i in range(0, len(combinations), SEARCH_CHUNK)]
+    formulas = {target: [] for target in TARGETS}
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for found in pool.map(_search_chunk, chunks, [nibbles] * len(chunks), [targets] * len(chunks)):
+            for formula in found:
+                formulas[formula.target].append(formula)
+    for target in TARGETS:
+        formulas[target].sort(key=lambda f: (len(f.terms), f.operation != 'xor', f.terms, f.constant))
+    return formulas
+
+
+def formula_constants(formulas, serial):
+    """Evaluate the simplest formula for each target into ecc constants for Fireplace(ecc_constants=...)"""
+    c1, d1, c2, d2 = (formulas[target][0].evaluate(serial) for target in TARGETS)
+    return (c1, d1), (c2, d2)
+
+
+def read_captures(paths):
+    """Decode the packets in hex dump capture files, without checking the error detection words"""
+    chunks = []
+    for path in paths:
+        with open(path) as capture:
+            for line in capture:
+                line = line.strip()
+                if line:
+                    chunks.append(binascii.unhexlify(line))
+    return list(decode_stream(chunks, check_ecc=False))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    solutions = solve_corpus(read_captures(sys.argv[1:]))
+    for serial, solution in sorted(solutions.items()):
+        logging.info('Serial {}: ecc_constants={} agreeing with {:.0%} of {} captures'.format(
+            list(serial), solution.ecc_constants, solution.agreement, solution.captures))
+    if len(solutions) > 1:
+        for target, found in sorted(search_formulas(solutions).items()):
+            logging.info('{} formulas found, simplest: {}'.format(len(found), found[0] if found else None))
@@ -0,0 +1,167 @@
+#!/usr/bin/python
+"""
+events.py: Stream of fireplace state changes for push clients.
+
+Every state sent by a fireplace in the registry that differs from the last one seen for it becomes an event with the
+next sequence number. Event ids are the epoch of the process, the time it started in milliseconds, and the sequence,
+like 1760799600123-42. Recent events are kept in a ring buffer, so a client that reconnects with the last id it saw
+gets exactly what it missed. If it missed more than the buffer holds, or the id is from another epoch because the
+server restarted, it gets the current state of every fireplace instead. The servers expose this as Server-Sent Events
+and as a long poll.
+"""
+
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+
+from .registry import fireplace_id
+
+# Events kept for clients catching up after a disconnect
+DEFAULT_HISTORY = 256
+
+# Seconds between keep alive comments on an idle event stream, and the longest a long poll waits
+KEEPALIVE = 15.0
+POLL_TIMEOUT = 25.0
+
+
+class EventId(namedtuple('EventId', 'epoch sequence')):
+    """Position in the event stream of one process, written as epoch-sequence"""
+
+    __slots__ = ()
+
+    def __str__(self):
+        return '{}-{}'.format(self.epoch, self.sequence)
+
+
+class StateEvents(object):
+    """Sequenced state change events for every fireplace in a registry"""
+
+    def __init__(self, registry, history=DEFAULT_HISTORY):
+        self._registry = registry
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._events = deque(maxlen=history)  # (EventId, id, FireplaceState)
+        self._latest = {}  # id -> FireplaceState last published
+        self._epoch = int(time.time() * 1000)  # tells ids from before a restart apart
+        self._sequence = 0
+        self._wakers = []
+        for fireplace in registry:
+            self._latest[fireplace_id(fireplace.serial)] = fireplace.snapshot
+            fireplace.add_listener(self.publish)
+
+    @property
+    def sequence(self):
+        """Sequence number of the newest event, 0 before the first one"""
+        with self._lock:
+            return self._sequence
+
+    @property
+    def last_id(self):
+        """EventId of the newest event"""
+        with self._lock:
+            return EventId(self._epoch, self._sequence)
+
+    def publish(self, fireplace, state):
+        """Fireplace listener, adds an event when the state differs from the last one published for the fireplace"""
+        key = fireplace_id(fireplace.serial)
+        with self._lock:
+            if self._latest.get(key) == state:
+                return
+            self._latest[key] = state
+            self._sequence += 1
+            self._events.append((EventId(self._epoch, self._sequence), key, state))
+            self._changed.notify_all()
+            wakers = list(self._wakers)
+        for waker in wakers:
+            try:
+                waker()
+            except Exception:
+                logging.exception('State event waker failed')
+
+    def add_waker(self, waker):
+        """Call waker() after each new event, from the thread that published it"""
+        with self._lock:
+            self._wakers.append(waker)
+
+    def remove_waker(self, waker):
+        with self._lock:
+            self._wakers.remove(waker)
+
+    def since(self, last):
+        """Events after the given EventId as (EventId, id, FireplaceState)
+
+        For a new client, with None, or when the events are no longer all in the history, or the id is from another
+        epoch, the current state of every fireplace is returned instead, all with the id of the newest event."""
+        with self._lock:
+            if (last is None or last.epoch != self._epoch or last.sequence > self._sequence or
+                    (self._events and self._events[0][0].sequence > last.sequence + 1)):
+                newest = EventId(self._epoch, self._sequence)
+                return [(newest, key, state) for key, state in sorted(self._latest.items())]
+            return [event for event in self._events if event[0].sequence > last.sequence]
+
+    def wait(self, last, timeout=POLL_TIMEOUT):
+        """Block until there are events after the EventId or the timeout passes, and return them"""
+        if last is not None:
+            with self._lock:
+                self._changed.wait_for(lambda: (self._epoch, self._sequence) != last, timeout)
+        return self.since(last)
+
+    async def wait_async(self, last, timeout=POLL_TIMEOUT):
+        """Like wait, without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+
+        def waker():
+            loop.call_soon_threadsafe(changed.set)
+
+        self.add_waker(waker)
+        try:
+            if last is not None and self.last_id == last:
+                await asyncio.wait_for(changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.remove_waker(waker)
+        return self.since(last)
+
+
+def event_json(event):
+    """Compact JSON for an event: its event id, fireplace id and state values"""
+    last, key, state = event
+    return json.dumps({'seq': str(last), 'id': key, 'state': state.as_dict()}, separators=(',', ':'))
+
+
+def sse_message(event):
+    """An event formatted for a text/event-stream, with its event id for Last-Event-ID"""
+    return 'id: {}\nevent: state\ndata: {}\n\n'.format(event[0], event_json(event))
+
+
+def event_stream(events, last, keepalive=KEEPALIVE):
+    """Generate text/event-stream chunks forever, starting after the EventId, for a blocking server thread"""
+    changes = events.since(last)
+    while True:
+        for event in changes:
+            last = event[0]
+            yield sse_message(event)
+        changes = events.wait(last, keepalive)
+        if not changes:
+            yield ': keepalive\n\n'
+
+
+def poll_json(events, last):
+    """Long poll response body with the events and the event id to send next time"""
+    last = events[-1][0] if events else last
+    return '{{"seq":{},"events":[{}]}}'.format(json.dumps(None if last is None else str(last)),
+                                                ','.join(event_json(event) for event in events))
+
+
+def parse_event_id(text):
+    """EventId from a Last-Event-ID header or since parameter, None for a new client or anything else"""
+    try:
+        epoch, sequence = text.split('-')
+        return EventId(int(epoch), max(int(sequence), 0))
+    except (AttributeError, ValueError):
+        return None
@@ -5,51 +5,126 @@ fireplace.py: Python implementation of the Sit Group's Proflame 2 remote firepla
 
 __version__ = "0.0.1"
 
+import argparse
 import logging
-import sys
+import threading
+import time
+from concurrent.futures import Future
 
-#from past.translation import autotranslate
+if not __package__:
+    # run as a script, or imported from this directory, load the modules below as part of the package
+    import os
+    import sys
 
-#autotranslate('rflib')
-from rflib import RfCat, MOD_ASK_OOK
-from bitstring import Bits, BitArray
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = os.path.basename(os.path.dirname(os.path.abspath(__file__)))
+    __import__(__package__)
+
+from .codec import DEFAULT_ECC_CONSTANTS, PACKET_BYTES, encode_packet, serial_words
+from .confirm import send_confirmed
+from .radio import open_radio, transmit
+from .state import FireplaceState
 
 # Serial number words, including padding bit at the end
 DEFAULT_SERIAL = ['001001011', '011110100', '000000100']
 
+# Power off with the pilot on
+INITIAL_STATE = FireplaceState.from_values(pilot=True)
+
+# Transmit priorities, commands that turn the fireplace off go first, see Fireplace.priority
+PRIORITY_NORMAL = 0
+PRIORITY_SAFETY = 10
+
+
+def validate(**values):
+    """Check state values before applying them, raising ValueError for unknown names or out of range levels"""
+    INITIAL_STATE.replace(**values)
+
+
+class Transaction(object):
+    """Context manager grouping several changes to a fireplace into one transmission, see Fireplace.batch"""
+
+    def __init__(self, fireplace, force=False):
+        self._fireplace = fireplace
+        self._force = force
+        self.state = None  # the changes so far, only the block's own thread sees them
+        self.thread = None
+        self.changed = False
+        self.result = None  # what Fireplace.transmit_state returned, once the block exits
+
+    def __enter__(self):
+        # other writers wait for the whole block, readers keep going
+        self._fireplace._lock.acquire()
+        if self._fireplace._transaction is not None:
+            self._fireplace._lock.release()
+            raise RuntimeError("Fireplace is already in a batch")
+        self.state = self._fireplace._state
+        self.thread = threading.get_ident()
+        self._fireplace._transaction = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fireplace = self._fireplace
+        try:
+            fireplace._transaction = None
+            if exc_type is None and self.changed:
+                # the staged state replaces the current one only once it is sent or queued
+                self.result = fireplace._transmit(self.state, self._force)
+            return False
+        finally:
+            fireplace._lock.release()
+
 
 class Fireplace(object):
-    """Model for the fireplace state and controls"""
+    """Model for the fireplace state and controls
 
-    def __init__(self, serial=None):
-        self._radio = None
+    Safe to share between threads. Writers take a lock around changing, encoding and sending or queueing the state,
+    so every packet matches a whole requested state. The state itself is an immutable FireplaceState replaced in one
+    assignment, so readers never take the lock and never wait for the radio."""
+
+    def __init__(self, serial=None, table=None, ecc_constants=None, worker=None, confirm=False, radio=None,
+                 reassert=None):
+        self._radio = radio  # RadioBackend, the RfCat dongle is opened on first use if not given
+        self._worker = worker  # optional RadioWorker that owns the radio and sends in the background
+        self._confirm = confirm  # listen for the echo after sending, and resend until it arrives
         self._serial = DEFAULT_SERIAL if serial is None else serial
-        self._pilot = True
-        self._light = 0
-        self._thermostat = False
-        self._power = False
-        self._front = False
-        self._fan = 0
-        self._aux = False
-        self._flame = 0
+        # error detection constants ((C1, D1), (C2, D2)), see ecc_solver.py for recovering them from captures
+        self._ecc_constants = DEFAULT_ECC_CONSTANTS if ecc_constants is None else tuple(map(tuple, ecc_constants))
+        if table is not None and list(table.serial) != list(self._serial):
+            raise ValueError("Packet table was built for serial {}".format(table.serial))
+        if table is not None and table.ecc_constants != self._ecc_constants:
+            raise ValueError("Packet table was built for ecc constants {}".format(table.ecc_constants))
+        self._table = table  # optional precomputed PacketTable for this serial
+        self._serial_words = serial_words(self._serial)
+        self._buffer = bytearray(PACKET_BYTES)  # reused for every encoded packet
+        self._lock = threading.RLock()  # held by writers from changing the state until it is sent or queued
+        self._transaction = None  # open Transaction, setters only change its staged state while it is set
+        self._reassert = reassert  # seconds after which an unchanged state is sent again, never when None
+        self._sent = None  # last state sent and confirmed, or queued, None when unknown
+        self._sent_time = 0.0
+        self._sent_lock = threading.Lock()  # worker callbacks record deliveries from the radio thread
+        self._listeners = []  # called with (fireplace, state) for every state sent
+        self.transmissions_performed = 0
+        self.transmissions_avoided = 0  # sets that matched the last state sent
+        self._state = INITIAL_STATE
 
     @property
     def radio(self):
         if self._radio is None:
-            # Single radio configuration. The USB interface gets confused if this used multiple times.
-            self._radio = RfCat()
-            self._radio.setFreq(314973000)
-            self._radio.setMdmModulation(MOD_ASK_OOK)
-            self._radio.setMdmDRate(2400)
+            self._radio = open_radio()
         return self._radio
 
     @property
     def serial(self):
         return self._serial
 
+    @property
+    def ecc_constants(self):
+        return self._ecc_constants
+
     @property
     def pilot(self):
-        return self._pilot
+        return self._current.pilot
 
     @pilot.setter
     def pilot(self, value):
@@ -57,7 +132,7 @@ class Fireplace(object):
 
     @property
     def light(self):
-        return self._light
+        return self._current.light
 
     @light.setter
     def light(self, value):
@@ -65,7 +140,7 @@ class Fireplace(object):
 
     @property
     def thermostat(self):
-        return self._thermostat
+        return self._current.thermostat
 
     @thermostat.setter
     def thermostat(self, value):
@@ -73,7 +148,7 @@ class Fireplace(object):
 
     @property
     def power(self):
-        return self._power
+        return self._current.power
 
     @power.setter
     def power(self, value):
@@ -81,7 +156,7 @@ class Fireplace(object):
 
     @property
     def front(self):
-        return self._front
+        return self._current.front
 
     @front.setter
     def front(self, value):
@@ -89,7 +164,7 @@ class Fireplace(object):
 
     @property
     def fan(self):
-        return self._fan
+        return self._current.fan
 
     @fan.setter
     def fan(self, value):
@@ -97,7 +172,7 @@ class Fireplace(object):
 
     @property
     def aux(self):
-        return self._aux
+        return self._current.aux
 
     @aux.setter
     def aux(self, value):
@@ -105,149 +180,215 @@ class Fireplace(object):
 
     @property
     def flame(self):
-        return self._flame
+        return self._current.flame
 
     @flame.setter
     def flame(self, value):
         self.set(flame=value)
 
+    @property
+    def _current(self):
+        """The state as seen by this thread, with the changes staged in its open batch"""
+        transaction = self._transaction
+        if transaction is not None and transaction.thread == threading.get_ident():
+            return transaction.state
+        return self._state
+
     @property
     def state(self):
-        return {'serial': self.serial, 'pilot': self.pilot, 'light': self.light, 'therostat': self.thermostat,
-                'power': self.power,
-                'front': self.front, 'fan': self.fan, 'aux': self.aux, 'flame': self.flame}
+        values = self._current.as_dict()
+        values['serial'] = self.serial
+        return values
+
+    @property
+    def snapshot(self):
+        """The current state as an immutable, hashable FireplaceState, without changes staged in an open batch"""
+        return self._state
 
     @state.setter
     def state(self, values):
-        set(**values)
+        self.set(**values)
 
     def set(self, serial=None, pilot=None, light=None, thermostat=None, power=None, front=None, fan=None, aux=None,
-            flame=None):
+            flame=None, force=False):
+        """Change the given values and transmit the new state
+
+        Returns a Future for the transmission when the fireplace has a worker. Otherwise it returns once the packet is
+        sent, with the confirm.Delivery if confirmation is enabled or None if not. Inside a batch nothing is sent and
+        None is returned. Nothing is sent either when the state matches the last one sent, see transmit_state. The new
+        state only becomes the current one once it is sent or queued, if that raises nothing changes."""
+        with self._lock:
+            state = self._changed(pilot=pilot, light=light, thermostat=thermostat, power=power, front=front, fan=fan,
+                                  aux=aux, flame=flame)
+            if self._transaction is not None:
+                self._transaction.state = state
+                self._transaction.changed = True
+                return None
+            return self._transmit(state, force)
+
+    def due(self, force=False, state=None):
+        """Whether the current state, or the given one, needs to go on air: it differs from the last one sent, that one
+        was never confirmed, the re-assert interval has passed, or force is set
+
+        The handheld remote may have changed the fireplace since, so an explicit off is sent with force, see
+        state.turns_off, and a re-assert interval covers everything else."""
+        state = self._state if state is None else state
+        with self._sent_lock:
+            if force or state != self._sent:
+                return True
+            return self._reassert is not None and time.time() - self._sent_time >= self._reassert
+
+    def transmit_state(self, force=False):
+        """Send the current state if it is due, returning what send_packet returns
+
+        When it is not due the transmission is avoided and counted, and None is returned, or a completed Future when
+        the fireplace has a worker."""
+        with self._lock:
+            return self._transmit(self._state, force)
+
+    def _transmit(self, state, force):
+        # called with the lock held, the state becomes the current one once it is sent or queued
+        if not self.due(force, state):
+            self._state = state
+            self.transmissions_avoided += 1
+            if self._worker is None:
+                return None
+            future = Future()
+            future.set_result(None)
+            return future
+        result = self.send_packet(self.encode(state), state)
+        self._state = state
+        self.record_sent(state, result)
+        return result
+
+    def record_sent(self, state, result=None):
+        """Remember the state as the last one sent, given what send_packet returned for it
+
+        An unconfirmed delivery or a failed queued transmission forgets it, so the next set sends again."""
+        self.transmissions_performed += 1
+        for listener in list(self._listeners):
+            try:
+                listener(self, state)
+            except Exception:
+                logging.exception('Fireplace listener failed')
+        if isinstance(result, Future):
+            result.add_done_callback(lambda future: self._delivered(state, future))
+        self._delivered(state, result)
+
+    def _delivered(self, state, result):
+        if isinstance(result, Future):
+            if not result.done():
+                confirmed = True  # queued, assume it goes out unless the future says otherwise
+            elif result.cancelled() or result.exception() is not None:
+                confirmed = False
+            else:
+                confirmed = getattr(result.result(), 'confirmed', True)
+        else:
+            confirmed = getattr(result, 'confirmed', True)
+        with self._sent_lock:
+            if confirmed:
+                self._sent = state
+                self._sent_time = time.time()
+            elif self._sent == state:
+                self._sent = None
+
+    def add_listener(self, listener):
+        """Call listener(fireplace, state) with each new state sent, from the writer's thread with the lock held"""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def restore(self, state):
+        """Set the model to a known state, like one replayed from a StateJournal, without transmitting it"""
+        with self._lock:
+            self._state = state
+
+    @property
+    def transmission_stats(self):
+        return {'performed': self.transmissions_performed, 'avoided': self.transmissions_avoided}
+
+    def batch(self, force=False):
+        """Group changes into one transmission, for use as 'with fp.batch(): fp.power = True; fp.flame = 3'
+
+        Setters inside the block are checked right away and staged, and one packet with the final state is sent when the
+        block ends. Only the thread running the block sees the staged values, everyone else keeps reading the state
+        from before the block until the packet is sent or queued. If the block raises, or the packet can not be sent or
+        queued, nothing changes. The Transaction returned holds the transmit_state result once the block ends."""
+        return Transaction(self, force)
+
+    transaction = batch
+
+    def update(self, pilot=None, light=None, thermostat=None, power=None, front=None, fan=None, aux=None, flame=None):
+        """Change the given values of the model without transmitting, all values are checked before any change"""
+        with self._lock:
+            state = self._changed(pilot=pilot, light=light, thermostat=thermostat, power=power, front=front, fan=fan,
+                                  aux=aux, flame=flame)
+            if self._transaction is None:
+                self._state = state
+            else:
+                self._transaction.state = state
+
+    def _changed(self, pilot, light, thermostat, power, front, fan, aux, flame):
+        # called with the lock held, so the transaction is only ever the caller's own
         print('Setting pilot:{}, light:{}, thermostat:{}, power:{}, front:{}, fan:{}, aux:{}, flame:{}'.format(
             pilot, light, thermostat, power, front, fan, aux, flame
         ))
-        if pilot is not None:
-            # set pilot
-            self._pilot = pilot
-        if light is not None:
-            # set light
-            if (light < 0) or (light > 6):
-                raise ValueError("Light value must be between 0 and 6 inclusive")
-            self._light = light
-        if thermostat is not None:
-            # set thermostat
-            self._thermostat = thermostat
-        if power is not None:
-            # set power
-            self._power = power
-        if front is not None:
-            # set front
-            self._front = front
-        if fan is not None:
-            # set fan
-            if (fan < 0) or (fan > 6):
-                raise ValueError("Fan value must be between 0 and 6 inclusive")
-            self._fan = fan
-        if aux is not None:
-            # set aux
-            self._aux = aux
-        if flame is not None:
-            # set flame
-            if (flame < 0) or (flame > 6):
-                raise ValueError("Flame value must be between 0 and 6 inclusive")
-            self._flame = flame
-
-        packet = self.build_packet()
-        self.send_packet(packet)
-
-    def build_packet(self):
-        """Build the complete encoded packet ready for transmission and return it as a BitArray"""
-        packet_words = []
-
-        # stat with the 3 word serial number
-        packet_words.extend([Bits(bin=s) for s in self.serial])
-
-        # build the first command word
-        cmd1 = BitArray()
-        cmd1.append('0b1' if self.pilot else '0b0')  # 1 pilot bit
-        cmd1.append(Bits(uint=self.light, length=3))  # 3 light bits
-        cmd1.append('0b00')  # 2 zero bits
-        cmd1.append('0b1' if self.thermostat else '0b0')  # 1 thermostat bit
-        cmd1.append('0b1' if self.power else '0b0')  # 1 power bit
-        cmd1.append('0x0')  # 1 zero padding bit
-        packet_words.append(cmd1)
-
-        # build the second command word
-        cmd2 = BitArray()
-        cmd2.append('0b1' if self.front else '0b0')  # 1 pilot bit
-        cmd2.append(Bits(uint=self.fan, length=3))  # 3 light bits
-        cmd2.append('0b1' if self.aux else '0b0')  # 1 pilot bit
-        cmd2.append(Bits(uint=self.flame, length=3))  # 3 light bits
-        cmd2.append('0x0')  # 1 zero padding bit
-        packet_words.append(cmd2)
-
-        # calculate the first ecc word
-        ecc1 = BitArray()
-        ecc1_high = (0xD ^ cmd1[0:4].uint ^ (cmd1[0:4].uint << 1) ^ (cmd1[4:8].uint << 1)) & 0xF
-        ecc1_low = cmd1[0:4].uint ^ cmd1[4:8].uint
-        ecc1.append(Bits(uint=ecc1_high, length=4))  # 4 high ecc bits
-        ecc1.append(Bits(uint=ecc1_low, length=4))  # 4 low ecc bits
-        ecc1.append('0x0')  # 1 zero padding bit
-        packet_words.append(ecc1)
-
-        # calculate the second ecc word
-        ecc2 = BitArray()
-        ecc2_high = (cmd2[0:4].uint ^ (cmd2[0:4].uint << 1) ^ (cmd2[4:8].uint << 1)) & 0xF
-        ecc2_low = cmd2[0:4].uint ^ cmd2[4:8].uint ^ 0x7
-        ecc2.append(Bits(uint=ecc2_high, length=4))  # 4 high ecc bits
-        ecc2.append(Bits(uint=ecc2_low, length=4))  # 4 low ecc bits
-        ecc2.append('0x0')  # 1 zero padding bit
-        packet_words.append(ecc2)
-
-        # convert the packet array to a bit string for encoding
-        packet_string = ''
-        for word in packet_words:
-            packet_string += 'S'  # sync symbol
-            packet_string += '1'  # start guard bit
-            packet_string += word[0:9].bin  # data
-            parity = word.count('0x1') % 2  # calculate parity on all 9 bits
-            packet_string += Bits(uint=parity, length=1).bin  # parity bit
-            packet_string += '1'  # end guard bit 1
-        packet_string += 'Z' * 9  # zero padding at the end, required for burst separation
-
-        logging.debug('packet string:', packet_string)
-        logging.debug('packet string length:', len(packet_string))
-        for p in packet_string.split('S'):
-            if len(p) == 0:
-                continue
-            logging.debug('S{} {} {} {}'.format(p[0:1], p[1:5], p[5:9], p[9:12]))
-
-        # encode the packet
-
-        # extended thomas manchester codes with sync and zero codes
-        manchester_codes = {'S': '11', '0': '01', '1': '10', 'Z': '00'}
-        packet_array = [manchester_codes[b] for b in packet_string]
-        packet = BitArray()
-        for b in packet_array:
-            packet.append(Bits(bin=b))
-
-        # return the result
-        logging.debug('manchester encoded packet:', packet.bin)
-        logging.debug('length:', len(packet.bin))
-        return packet
-
-    def send_packet(self, packet):
-        """Transmit the packet over the radio 5 times"""
-        logging.info('Transmitting {}'.format(packet.hex))
-        self.radio.setModeIDLE()
-        self.radio.RFxmit(data=packet.bytes, repeat=4)  # protocol requires 5 transmissions, which is what repeat=4 does
+        current = self._state if self._transaction is None else self._transaction.state
+        return current.replace(pilot=pilot, light=light, thermostat=thermostat, power=power, front=front, fan=fan,
+                               aux=aux, flame=flame)
+
+    @property
+    def lock(self):
+        """The writer lock, for callers that change, encode and send the state in separate steps like the registry"""
+        return self._lock
+
+    def encode(self, state=None):
+        """Return the encoded packet for the current state, or the given one, from the packet table when there is one
+
+        Call with the lock held, the packet is built in a buffer shared by every writer."""
+        state = self._state if state is None else state
+        if self._table is None:
+            return self.build_packet(state)
+        return self._table.lookup(*state.values)
+
+    def build_packet(self, state=None):
+        """Build the complete encoded packet for the current state, or the given one, and return it as a bytearray
+
+        The packet is encoded into a buffer owned by this instance, so it is only valid until the next call."""
+        cmd1, cmd2 = (self._state if state is None else state).command_bytes
+        return encode_packet(self._serial_words, cmd1, cmd2, self._ecc_constants, out=self._buffer)
+
+    def priority(self, state):
+        """PRIORITY_SAFETY if sending the state turns the fireplace off, or may, when the last state sent is unknown
+
+        Other changes while the power is off, like the pilot or the light, are PRIORITY_NORMAL."""
+        with self._sent_lock:
+            sent = self._sent
+        if not state.power and (sent is None or sent.power):
+            return PRIORITY_SAFETY
+        return PRIORITY_NORMAL
+
+    def send_packet(self, packet, state=None):
+        """Transmit the encoded packet bytes over the radio 5 times
+
+        With a worker the packet is queued instead, prioritized by the state it encodes, the current one if not given,
+        and a Future for the transmission is returned."""
+        if self._worker is not None:
+            priority = self.priority(self._state if state is None else state)
+            return self._worker.submit(tuple(self._serial), bytes(packet), priority=priority,
+                                       ecc_constants=self._ecc_constants)
+        if self._confirm:
+            return send_confirmed(self.radio, bytes(packet), ecc_constants=self._ecc_constants)
+        transmit(self.radio, packet)
 
 
 if __name__ == "__main__":
+    from .cli import add_value_arguments, given_values
+
+    parser = argparse.ArgumentParser(description="Open the radio and send one command, cli.py is much faster when the "
+                                                 "broker.py daemon is running")
+    add_value_arguments(parser)
     logging.info('main')
     fire = Fireplace()
-    # fire.set(power=True, flame=1)
-    # fire.set(power=False)
-    cmd = 'fire.set(' + ','.join(sys.argv[1:]) + ')'
-    print(cmd)
-    exec(cmd)
+    fire.set(force=True, **given_values(parser.parse_args()))
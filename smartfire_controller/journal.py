@@ -0,0 +1,259 @@
+#!/usr/bin/python
+"""
+journal.py: Crash safe record of the last commanded state of every fireplace.
+
+Every state sent is appended to a binary journal as a small fixed size record with its own checksum. A background
+thread writes whatever has queued up and syncs it to disk with one fsync, so a burst of commands costs one disk flush
+and callers never wait for the disk. Every so often the latest state of each fireplace is written to a snapshot file,
+atomically by renaming a synced temporary file, and the journal starts over. On startup the snapshot and the journal
+after it are replayed, stopping at the first torn or corrupt record, to restore the state from before the restart.
+When a group commit fails the journal is cut back to the end of the last synced one and the group is dropped, so a
+half written group never reaches the replay.
+"""
+
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from .state import FireplaceState
+
+JOURNAL_MAGIC = b'SFJ1'
+SNAPSHOT_MAGIC = b'SFS1'
+
+# crc32, time, serial, state bits, the crc covers the rest of the record
+RECORD = struct.Struct('<IdIH')
+# serial, state bits
+SNAPSHOT_ENTRY = struct.Struct('<IH')
+SNAPSHOT_HEADER = struct.Struct('<4sI')  # magic, entry count, followed by the entries and a crc32 of them
+
+JOURNAL_FILE = 'journal'
+SNAPSHOT_FILE = 'snapshot'
+
+# Longest a queued record waits for the next group commit, in seconds
+DEFAULT_SYNC_DELAY = 0.05
+# Journal records written before the next snapshot and compaction
+DEFAULT_SNAPSHOT_EVERY = 1000
+
+
+def serial_key(serial):
+    """Pack the three 9 bit serial words into one int"""
+    return int(''.join(serial), 2)
+
+
+def _pack_record(timestamp, key, bits):
+    body = RECORD.pack(0, timestamp, key, bits)[4:]
+    return struct.pack('<I', zlib.crc32(body) & 0xFFFFFFFF) + body
+
+
+def read_journal(path):
+    """Yield (time, serial key, FireplaceState) for each intact record, stopping at the first damaged one"""
+    try:
+        with open(path, 'rb') as journal:
+            data = journal.read()
+    except IOError:
+        return
+    if data[:len(JOURNAL_MAGIC)] != JOURNAL_MAGIC:
+        return
+    for offset in range(len(JOURNAL_MAGIC), len(data) - RECORD.size + 1, RECORD.size):
+        crc, timestamp, key, bits = RECORD.unpack_from(data, offset)
+        if zlib.crc32(data[offset + 4:offset + RECORD.size]) & 0xFFFFFFFF != crc:
+            logging.warning('Journal {} damaged at byte {}, replay stops there'.format(path, offset))
+            return
+        yield timestamp, key, FireplaceState(bits)
+
+
+def read_snapshot(path):
+    """Return {serial key: FireplaceState} from a snapshot file, empty if it is missing or damaged"""
+    try:
+        with open(path, 'rb') as snapshot:
+            data = snapshot.read()
+    except IOError:
+        return {}
+    if len(data) < SNAPSHOT_HEADER.size + 4:
+        return {}
+    magic, count = SNAPSHOT_HEADER.unpack_from(data)
+    end = SNAPSHOT_HEADER.size + count * SNAPSHOT_ENTRY.size
+    if magic != SNAPSHOT_MAGIC or len(data) != end + 4:
+        return {}
+    if zlib.crc32(data[SNAPSHOT_HEADER.size:end]) & 0xFFFFFFFF != struct.unpack_from('<I', data, end)[0]:
+        logging.warning('Snapshot {} is damaged, ignoring it'.format(path))
+        return {}
+    return {key: FireplaceState(bits) for key, bits in SNAPSHOT_ENTRY.iter_unpack(data[SNAPSHOT_HEADER.size:end])}
+
+
+def _write_synced(path, data):
+    """Replace the file with the data, so it holds either the old or the new content after a crash"""
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as output:
+        output.write(data)
+        output.flush()
+        os.fsync(output.fileno())
+    os.rename(temporary, path)
+    directory = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+class StateJournal(object):
+    """Append only journal of commanded states with group commit, snapshots and compaction
+
+    Feed it with Fireplace.add_listener(journal.record), or attach it to a FireplaceRegistry."""
+
+    def __init__(self, directory, sync_delay=DEFAULT_SYNC_DELAY, snapshot_every=DEFAULT_SNAPSHOT_EVERY):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._journal_path = os.path.join(directory, JOURNAL_FILE)
+        self._snapshot_path = os.path.join(directory, SNAPSHOT_FILE)
+        self._sync_delay = sync_delay
+        self._snapshot_every = snapshot_every
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._flushed = threading.Condition(self._lock)
+        self._queue = []
+        self._closed = False
+        self._latest = self.load()  # serial key -> FireplaceState, what the next snapshot holds
+        self._since_snapshot = 0
+        self._file = None
+        self._offset = 0  # end of the last synced record
+        self.records = 0
+        self.dropped = 0  # records lost to failed commits
+        self.syncs = 0
+        self.snapshots = 0
+        self._compact()  # start from a snapshot of the replayed state and an empty journal
+        self._thread = threading.Thread(target=self._run, name='state-journal')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def load(self):
+        """Replay the snapshot and the journal after it into {serial key: FireplaceState}"""
+        latest = read_snapshot(self._snapshot_path)
+        for timestamp, key, state in read_journal(self._journal_path):
+            latest[key] = state
+        return latest
+
+    def state(self, serial):
+        """The last recorded state of the fireplace with the given serial, or None"""
+        with self._lock:
+            return self._latest.get(serial_key(serial))
+
+    def record(self, fireplace, state):
+        """Queue the fireplace's new state for the next group commit, returns right away"""
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("State journal is closed")
+            self._queue.append((time.time(), serial_key(fireplace.serial), state.bits))
+            self._not_empty.notify()
+
+    def flush(self, timeout=None):
+        """Wait until every record queued so far is on disk, False if that times out or any of them were dropped"""
+        with self._lock:
+            dropped = self.dropped
+            target = self.records + dropped + len(self._queue)
+            self._not_empty.notify()
+            while self.records + self.dropped < target and not self._closed:
+                if not self._flushed.wait(timeout):
+                    return False
+            return self.records + self.dropped >= target and self.dropped == dropped
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._queue and not self._closed:
+                    self._not_empty.wait()
+                if not self._queue and self._closed:
+                    return
+            # let more records arrive so they share one fsync
+            time.sleep(self._sync_delay)
+            with self._lock:
+                batch, self._queue = self._queue, []
+            try:
+                self._commit(batch)
+            except (IOError, OSError):
+                logging.exception('Writing the state journal failed, dropping {} records'.format(len(batch)))
+                self._truncate()
+                with self._lock:
+                    self.dropped += len(batch)
+                    self._flushed.notify_all()
+                continue
+            with self._lock:
+                self.records += len(batch)
+                self._flushed.notify_all()
+            if self._since_snapshot >= self._snapshot_every:
+                try:
+                    self._compact()
+                except (IOError, OSError):
+                    logging.exception('Compacting the state journal failed')
+
+    def _commit(self, batch):
+        """Write and sync a group of records"""
+        if self._file is None:
+            raise IOError("State journal is not open")
+        self._file.write(b''.join(_pack_record(*record) for record in batch))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._offset = self._file.tell()
+        with self._lock:
+            self.syncs += 1
+            for timestamp, key, bits in batch:
+                self._latest[key] = FireplaceState(bits)
+        self._since_snapshot += len(batch)
+
+    def _truncate(self):
+        """Cut the journal back to the last synced record after a failed commit, and reopen it"""
+        if self._file is not None:
+            try:
+                self._file.close()
+            except (IOError, OSError):
+                pass  # flushing what is left of the failed group, it is cut off below
+            self._file = None
+        try:
+            with open(self._journal_path, 'r+b') as journal:
+                journal.truncate(self._offset)
+                os.fsync(journal.fileno())
+            self._file = open(self._journal_path, 'ab')
+        except (IOError, OSError):
+            logging.exception('Could not truncate the state journal, trying again after the next commit')
+
+    def _compact(self):
+        """Write a snapshot of the latest states and start an empty journal"""
+        with self._lock:
+            latest = OrderedDict(sorted(self._latest.items()))
+        entries = b''.join(SNAPSHOT_ENTRY.pack(key, state.bits) for key, state in latest.items())
+        _write_synced(self._snapshot_path, SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(latest)) + entries +
+                      struct.pack('<I', zlib.crc32(entries) & 0xFFFFFFFF))
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        _write_synced(self._journal_path, JOURNAL_MAGIC)
+        self._file = open(self._journal_path, 'ab')
+        self._offset = len(JOURNAL_MAGIC)
+        self._since_snapshot = 0
+        self.snapshots += 1
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {'records': self.records, 'dropped': self.dropped, 'queued': len(self._queue), 'syncs': self.syncs,
+                    'snapshots': self.snapshots, 'fireplaces': len(self._latest)}
+
+    def close(self):
+        """Write whatever is queued and stop the thread"""
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+        self._thread.join()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,51 @@
+#!/usr/bin/python
+"""
+packer.py: Pack several encoded bursts into as few USB transfers as possible.
+
+Sending a command costs a setModeIDLE and an RFxmit round trip over USB. A Proflame 2 burst is the packet sent 5 times,
+and every encoded packet already ends in 18 zero bits, more than the 12 the receiver needs between copies, so whole
+bursts can be laid end to end in one buffer and sent with a single RFxmit and no repeat. A burst is 125 bytes, so two
+fit in the dongle's 255 byte transmit block.
+"""
+
+import logging
+
+from .radio import MAX_PAYLOAD, REPEAT
+
+
+def burst(packet, repeat=REPEAT):
+    """The packet followed by its repeats, as the radio would send it with RFxmit(repeat=repeat)"""
+    return bytes(packet) * (repeat + 1)
+
+
+def pack_bursts(packets, repeat=REPEAT, max_payload=MAX_PAYLOAD):
+    """Concatenate the bursts of the packets into transmit buffers of at most max_payload bytes
+
+    Bursts are kept whole and in order. Raises ValueError if a single burst does not fit."""
+    buffers = []
+    current = bytearray()
+    for packet in packets:
+        data = burst(packet, repeat)
+        if len(data) > max_payload:
+            raise ValueError("Burst of {} bytes does not fit in a {} byte transfer".format(len(data), max_payload))
+        if len(current) + len(data) > max_payload:
+            buffers.append(bytes(current))
+            current = bytearray()
+        current += data
+    if current:
+        buffers.append(bytes(current))
+    return buffers
+
+
+def transmit_packed(radio, packets, repeat=REPEAT):
+    """Idle the radio once and send the packets' bursts in as few transmit calls as fit, returning the call count"""
+    packets = list(packets)
+    buffers = pack_bursts(packets, repeat, radio.max_payload)
+    if not buffers:
+        return 0
+    logging.info('Transmitting {} packets in {} transfers'.format(len(packets), len(buffers)))
+    with radio.session():
+        radio.idle()
+        for data in buffers:
+            radio.transmit(data, 0)
+    return len(buffers)
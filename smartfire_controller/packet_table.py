@@ -0,0 +1,126 @@
+#!/usr/bin/python
+"""
+packet_table.py: Precomputed table of every encoded Proflame 2 packet for a single serial number.
+
+The command space for one transmitter is small, so every packet can be encoded once, written to a flat binary file,
+and then looked up by memory mapping the file instead of encoding on every command.
+"""
+
+import logging
+import mmap
+import struct
+import sys
+
+if not __package__:
+    # run as a script, or imported from this directory, load the modules below as part of the package
+    import os
+    import sys
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = os.path.basename(os.path.dirname(os.path.abspath(__file__)))
+    __import__(__package__)
+
+from .codec import DEFAULT_ECC_CONSTANTS, command_bytes, encode_packet, serial_words, PACKET_BYTES
+from .fireplace import DEFAULT_SERIAL
+
+# Table file header: magic, format version, record size, record count, the three serial words and the ecc constants
+TABLE_MAGIC = b'PF2T'
+TABLE_VERSION = 2
+TABLE_HEADER = struct.Struct('<4sHHI3H4B')
+
+# Sizes of each dimension of the command space, in the order they are indexed
+LEVELS = 7  # 0 through 6 inclusive
+COMMAND1_STATES = 2 * LEVELS * 2 * 2  # pilot, light, thermostat, power
+COMMAND2_STATES = 2 * LEVELS * 2 * LEVELS  # front, fan, aux, flame
+TABLE_STATES = COMMAND1_STATES * COMMAND2_STATES
+
+
+def state_index(pilot, light, thermostat, power, front, fan, aux, flame):
+    """Return the position of a fireplace state in the packet table"""
+    cmd1 = ((int(pilot) * LEVELS + light) * 2 + int(thermostat)) * 2 + int(power)
+    cmd2 = ((int(front) * LEVELS + fan) * 2 + int(aux)) * LEVELS + flame
+    return cmd1 * COMMAND2_STATES + cmd2
+
+
+def iter_states():
+    """Generate every fireplace state tuple in table order"""
+    for pilot in (False, True):
+        for light in range(LEVELS):
+            for thermostat in (False, True):
+                for power in (False, True):
+                    for front in (False, True):
+                        for fan in range(LEVELS):
+                            for aux in (False, True):
+                                for flame in range(LEVELS):
+                                    yield pilot, light, thermostat, power, front, fan, aux, flame
+
+
+def build_table(path, serial=None, ecc_constants=DEFAULT_ECC_CONSTANTS):
+    """Encode every state for the serial number and write the packets to a table file"""
+    serial = DEFAULT_SERIAL if serial is None else serial
+    words = serial_words(serial)
+    (c1, d1), (c2, d2) = ecc_constants
+    packet = bytearray(PACKET_BYTES)
+    with open(path, 'wb') as table:
+        table.write(TABLE_HEADER.pack(TABLE_MAGIC, TABLE_VERSION, PACKET_BYTES, TABLE_STATES, words[0], words[1],
+                                      words[2], c1, d1, c2, d2))
+        for values in iter_states():
+            cmd1, cmd2 = command_bytes(*values)
+            table.write(encode_packet(words, cmd1, cmd2, ecc_constants, out=packet))
+    logging.info('Wrote {} packets of {} bytes to {}'.format(TABLE_STATES, PACKET_BYTES, path))
+
+
+class PacketTable(object):
+    """Read only, memory mapped view of a packet table file"""
+
+    def __init__(self, path, serial=None):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self._record_size, count, s1, s2, s3, c1, d1, c2, d2 = TABLE_HEADER.unpack_from(self._map, 0)
+        if magic != TABLE_MAGIC or version != TABLE_VERSION:
+            raise ValueError("{} is not a packet table file".format(path))
+        if count != TABLE_STATES or len(self._map) != TABLE_HEADER.size + count * self._record_size:
+            raise ValueError("Packet table {} is truncated or corrupt".format(path))
+        self._serial = ['{:09b}'.format(s) for s in (s1, s2, s3)]
+        self._ecc_constants = ((c1, d1), (c2, d2))
+        if serial is not None and list(serial) != self._serial:
+            raise ValueError("Packet table {} was built for serial {}".format(path, self._serial))
+        self._view = memoryview(self._map)[TABLE_HEADER.size:]
+
+    @property
+    def serial(self):
+        return self._serial
+
+    @property
+    def ecc_constants(self):
+        return self._ecc_constants
+
+    @property
+    def record_size(self):
+        return self._record_size
+
+    def __len__(self):
+        return TABLE_STATES
+
+    def lookup(self, pilot, light, thermostat, power, front, fan, aux, flame):
+        """Return a zero-copy view of the encoded packet for the state"""
+        if not (0 <= light < LEVELS and 0 <= fan < LEVELS and 0 <= flame < LEVELS):
+            raise ValueError("Level values must be between 0 and 6 inclusive")
+        offset = state_index(pilot, light, thermostat, power, front, fan, aux, flame) * self._record_size
+        return self._view[offset:offset + self._record_size]
+
+    def close(self):
+        self._view.release()
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    build_table(sys.argv[1] if len(sys.argv) > 1 else 'packets.bin')
@@ -0,0 +1,269 @@
+#!/usr/bin/python
+"""
+radio.py: Radio backends for sending and receiving Proflame 2 bursts.
+
+RfCatBackend drives a YardStick One, or another CC1101 based dongle, through rflib. SimulatedBackend models the USB
+round trip, the time on air and optional packet loss without any hardware, and records every burst so that the rest of
+the controller can be exercised, benchmarked and profiled on a plain Linux machine. SharedRadio lets several
+fireplaces share one of them from many threads.
+"""
+
+import contextlib
+import logging
+import random
+import threading
+import time
+from collections import deque, namedtuple
+
+# Radio settings
+FREQUENCY = 314973000
+DATA_RATE = 2400
+REPEAT = 4  # protocol requires 5 transmissions, which is what repeat=4 does
+
+# Largest buffer the dongle accepts in one RFxmit call, rflib's RF_MAX_TX_BLOCK
+MAX_PAYLOAD = 255
+
+# Seconds a receive call waits for data by default
+RECEIVE_TIMEOUT = 1.0
+
+# Fixed length of the packets the dongle receives, the echo of a burst is 125 bytes
+RECEIVE_LENGTH = 250
+
+
+class RadioBackend(object):
+    """Interface to a transceiver configured for the Proflame 2 protocol"""
+
+    max_payload = MAX_PAYLOAD  # bytes per transmit call, repeats not included
+
+    def configure(self):
+        """Set up the transceiver, called once before first use"""
+        raise NotImplementedError
+
+    def idle(self):
+        """Put the transceiver in its idle state, ready to transmit"""
+        raise NotImplementedError
+
+    def transmit(self, data, repeat=REPEAT):
+        """Transmit the data, followed by repeat more copies of it"""
+        raise NotImplementedError
+
+    def listen(self):
+        """Switch the transceiver to receive, as it is left idle after transmitting"""
+        raise NotImplementedError
+
+    def receive(self, timeout=RECEIVE_TIMEOUT):
+        """Return the next chunk of received bytes, or None if nothing arrives within the timeout in seconds"""
+        raise NotImplementedError
+
+    def close(self):
+        """Release the transceiver"""
+        pass
+
+    def session(self):
+        """Context manager holding the radio for a sequence of calls, like idling and transmitting
+
+        Nothing to hold for a radio used from one thread, see SharedRadio."""
+        return contextlib.nullcontext()
+
+
+class RfCatBackend(RadioBackend):
+    """Backend for an rflib RfCat dongle
+
+    Receiving is set up the first time listen() is called, the way old/cap.py captured the remote: no sync word, no
+    CRC and fixed length packets, so the dongle hands over the raw demodulated bits for the PacketDecoder to search.
+    Only echo confirmation listens, and it has not been verified against a fireplace on hardware yet, which is why it
+    is off unless asked for, and a radio that only transmits keeps the original modem settings."""
+
+    def __init__(self, index=0):
+        self._index = index
+        self._device = None
+        self._receiving = False  # receive settings applied
+
+    @property
+    def index(self):
+        return self._index
+
+    def configure(self):
+        from rflib import RfCat, MOD_ASK_OOK
+
+        # Single radio configuration. The USB interface gets confused if this used multiple times.
+        self._device = RfCat(idx=self._index)
+        self._device.setFreq(FREQUENCY)
+        self._device.setMdmModulation(MOD_ASK_OOK)
+        self._device.setMdmDRate(DATA_RATE)
+        self._receiving = False
+
+    def idle(self):
+        self._device.setModeIDLE()
+
+    def transmit(self, data, repeat=REPEAT):
+        self._device.RFxmit(data=data, repeat=repeat)
+
+    def listen(self):
+        if not self._receiving:
+            self._device.setModeIDLE()
+            self._device.lowball(level=1, length=RECEIVE_LENGTH)  # sync mode none, CRC off, fixed packet length
+            self._receiving = True
+        self._device.setModeRX()
+
+    def receive(self, timeout=RECEIVE_TIMEOUT):
+        from rflib import ChipconUsbTimeoutException
+
+        try:
+            data, timestamp = self._device.RFrecv(timeout=max(int(timeout * 1000), 1))
+        except ChipconUsbTimeoutException:
+            return None
+        return data
+
+    def close(self):
+        if self._device is None:
+            return
+        device, self._device = self._device, None
+        self._receiving = False
+        try:
+            device.setModeIDLE()
+        except Exception:
+            logging.exception('Could not idle radio {} before closing it'.format(self._index))
+        cleanup = getattr(device, 'cleanup', None)  # releases the USB interface in rflib versions that have it
+        if cleanup is not None:
+            cleanup()
+
+
+Burst = namedtuple('Burst', 'time data repeat delivered')
+
+
+class SimulatedBackend(RadioBackend):
+    """Hardware free backend modelling USB latency, time on air and packet loss
+
+    Every transmit call sleeps for the USB round trip plus the on air time of all copies, scaled by time_scale, and is
+    recorded in bursts. A delivered burst is echoed back to receive() like the fireplace does, but only heard once
+    listen() has switched the radio to receive. Loss is random with the given probability, or scripted per burst with
+    an iterable of booleans in echo_script."""
+
+    def __init__(self, usb_latency=0.004, data_rate=DATA_RATE, loss=0.0, echo=True, echo_script=None, time_scale=1.0,
+                 seed=None):
+        self.usb_latency = usb_latency
+        self.data_rate = data_rate
+        self.loss = loss
+        self.echo = echo
+        self.time_scale = time_scale
+        self._echo_script = iter(echo_script) if echo_script is not None else None
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._received = deque()
+        self._listening = False
+        self.bursts = []
+        self.usb_transfers = 0
+
+    def _sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds * self.time_scale)
+
+    def airtime(self, data, repeat=REPEAT):
+        """Seconds on air for the data and its repeats"""
+        return len(data) * 8 * (repeat + 1) / float(self.data_rate)
+
+    def configure(self):
+        self._sleep(self.usb_latency)
+
+    def idle(self):
+        with self._lock:
+            self.usb_transfers += 1
+            self._listening = False
+        self._sleep(self.usb_latency)
+
+    def transmit(self, data, repeat=REPEAT):
+        data = bytes(data)
+        with self._lock:
+            self.usb_transfers += 1
+            self._listening = False
+            if self._echo_script is not None:
+                delivered = next(self._echo_script, True)
+            else:
+                delivered = self._random.random() >= self.loss
+            self.bursts.append(Burst(time.time(), data, repeat, delivered))
+        self._sleep(self.usb_latency + self.airtime(data, repeat))
+        if delivered and self.echo:
+            with self._lock:
+                self._received.append(data * (repeat + 1))
+        logging.debug('Simulated burst {} delivered: {}'.format(data.hex(), delivered))
+
+    def listen(self):
+        with self._lock:
+            self.usb_transfers += 1
+            self._listening = True
+        self._sleep(self.usb_latency)
+
+    def receive(self, timeout=RECEIVE_TIMEOUT):
+        with self._lock:
+            data = self._received.popleft() if self._received and self._listening else None
+        if data is None:
+            self._sleep(timeout)
+            return None
+        self._sleep(self.usb_latency + len(data) * 8 / float(self.data_rate))
+        return data
+
+
+class SharedRadio(RadioBackend):
+    """A radio shared by several fireplaces and threads, opened on first use
+
+    Every call holds a reentrant lock, and session() holds it for a whole sequence of calls, so a burst from one thread
+    can never start between another thread's idle and transmit, or while it listens for an echo."""
+
+    def __init__(self, radio=None):
+        self._radio = radio  # the RfCat dongle is opened on first use if not given
+        self._lock = threading.RLock()
+
+    @property
+    def radio(self):
+        with self._lock:
+            if self._radio is None:
+                self._radio = open_radio()
+            return self._radio
+
+    @property
+    def max_payload(self):
+        return self.radio.max_payload
+
+    def configure(self):
+        with self._lock:
+            self.radio.configure()
+
+    def idle(self):
+        with self._lock:
+            self.radio.idle()
+
+    def transmit(self, data, repeat=REPEAT):
+        with self._lock:
+            self.radio.transmit(data, repeat)
+
+    def listen(self):
+        with self._lock:
+            self.radio.listen()
+
+    def receive(self, timeout=RECEIVE_TIMEOUT):
+        with self._lock:
+            return self.radio.receive(timeout)
+
+    def close(self):
+        with self._lock:
+            if self._radio is not None:
+                self._radio.close()
+
+    def session(self):
+        return self._lock
+
+
+def open_radio(index=0):
+    """Open the RfCat radio and configure it for the Proflame 2 protocol"""
+    radio = RfCatBackend(index)
+    radio.configure()
+    return radio
+
+
+def transmit(radio, packet):
+    """Transmit the encoded packet bytes over the radio 5 times"""
+    logging.info('Transmitting {}'.format(packet.hex()))
+    with radio.session():
+        radio.idle()
+        radio.transmit(packet, REPEAT)
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+"""
+radio_pool.py: Several transceivers shared by many fireplaces.
+
+Each radio gets its own RadioWorker thread, and every fireplace is assigned to one radio by its serial with rendezvous
+hashing, so commands for fireplaces on different radios go out in parallel. When a radio fails to transmit it is taken
+out of the pool, only the fireplaces it served move to the remaining radios, and the failed command is retried there.
+"""
+
+import hashlib
+import logging
+import threading
+from concurrent.futures import Future
+
+from .fireplace import PRIORITY_NORMAL
+from .radio import open_radio
+from .radio_worker import RadioWorker
+
+
+def find_radios():
+    """Open and configure every attached RfCat dongle"""
+    from rflib.chipcon_usb import getRfCatDevices
+
+    return [open_radio(index) for index in range(len(getRfCatDevices()))]
+
+
+class RadioPool(object):
+    """Shards fireplaces across radios, with a worker per radio and failover when a radio drops"""
+
+    def __init__(self, radios=None, worker_class=RadioWorker, **worker_options):
+        radios = find_radios() if radios is None else list(radios)
+        if not radios:
+            raise RuntimeError("No radios found")
+        self._lock = threading.Lock()
+        self._workers = [worker_class(radio=radio, name='radio-worker-{}'.format(index), **worker_options)
+                         for index, radio in enumerate(radios)]
+        self._healthy = [True] * len(self._workers)
+        self.failovers = 0
+
+    @property
+    def workers(self):
+        return list(self._workers)
+
+    @property
+    def healthy(self):
+        """Indexes of the radios still in the pool"""
+        with self._lock:
+            return [i for i, healthy in enumerate(self._healthy) if healthy]
+
+    @staticmethod
+    def _weight(key, index):
+        return hashlib.md5('{}/{}'.format(key, index).encode()).digest()
+
+    def assign(self, key):
+        """Index of the healthy radio serving the key"""
+        healthy = self.healthy
+        if not healthy:
+            raise RuntimeError("No healthy radios left in the pool")
+        return max(healthy, key=lambda index: self._weight(key, index))
+
+    def mark_failed(self, index):
+        """Take a radio out of the pool"""
+        with self._lock:
+            if self._healthy[index]:
+                logging.error('Radio {} failed, moving its fireplaces to the other radios'.format(index))
+                self._healthy[index] = False
+
+    def restore(self, index):
+        """Reopen a failed radio and put it back in the pool"""
+        radio = self._workers[index].radio
+        radio.close()  # the device may only be open once
+        radio.configure()
+        with self._lock:
+            self._healthy[index] = True
+
+    def submit(self, key, packet, timeout=None, priority=PRIORITY_NORMAL, ecc_constants=None):
+        """Queue the packet on the radio serving the key, returning a Future like RadioWorker.submit"""
+        result = Future()
+        self._submit(result, key, packet, timeout, priority, ecc_constants)
+        return result
+
+    def _submit(self, result, key, packet, timeout, priority, ecc_constants):
+        index = self.assign(key)
+        future = self._workers[index].submit(key, packet, timeout, priority, ecc_constants)
+
+        def done(future):
+            if future.cancelled():
+                result.cancel()
+                return
+            error = future.exception()
+            if error is None:
+                result.set_result(future.result())
+                return
+            self.mark_failed(index)
+            try:
+                with self._lock:
+                    self.failovers += 1
+                self._submit(result, key, packet, timeout, priority, ecc_constants)
+            except Exception as retry_error:
+                # no radio left, or the next one is closed or full, the caller waits on result so it must complete
+                if not isinstance(retry_error, RuntimeError):
+                    logging.exception('Could not move the command for {} to another radio'.format(key))
+                result.set_exception(error)
+
+        future.add_done_callback(done)
+
+    @property
+    def stats(self):
+        """Commands transmitted by each radio, and whether it is still in the pool"""
+        with self._lock:
+            return [{'transmitted': worker.transmitted, 'coalesced': worker.coalesced, 'packed': worker.packed,
+                     'healthy': healthy}
+                    for worker, healthy in zip(self._workers, self._healthy)]
+
+    def close(self, wait=True):
+        for worker in self._workers:
+            worker.close(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
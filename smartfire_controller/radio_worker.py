@@ -0,0 +1,198 @@
+#!/usr/bin/python
+"""
+radio_worker.py: Dedicated thread that owns the radio and transmits queued packets.
+
+Callers queue an encoded packet under a key, normally the fireplace serial, and get a Future back right away. If a
+packet for the same key is still waiting when a new one arrives, the new packet replaces it in place, so only the
+newest state for each fireplace goes on air and a burst of slider changes costs at most one stale transmission.
+Commands that are ready together are packed into one radio session and USB transfer, see packer.py, unless every
+packet has to wait for its echo.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from queue import Full
+
+from .codec import DEFAULT_ECC_CONSTANTS
+from .confirm import send_confirmed
+from .fireplace import PRIORITY_NORMAL
+from .packer import transmit_packed
+from .radio import open_radio, transmit
+
+# Maximum number of distinct keys waiting to be sent
+DEFAULT_QUEUE_SIZE = 16
+
+# Most commands sent in one radio session, two bursts fill a transfer and a larger pack delays newer commands
+DEFAULT_PACK = 2
+
+
+class _Command(object):
+    """A pending transmission and every caller waiting on it"""
+
+    def __init__(self, packet, future, ecc_constants):
+        self.packet = packet
+        self.ecc_constants = ecc_constants
+        self.futures = [future]
+        self.queued = time.time()
+
+
+class RadioWorker(object):
+    """Thread owning one radio, sending queued packets with last-write-wins coalescing per key"""
+
+    def __init__(self, radio=None, maxsize=DEFAULT_QUEUE_SIZE, name='radio-worker', confirm=False,
+                 ecc_constants=DEFAULT_ECC_CONSTANTS, pack=DEFAULT_PACK):
+        if pack < 1:
+            raise ValueError("Pack must be at least 1")
+        self._radio = radio
+        self._confirm = confirm  # wait for the fireplace echo, futures then complete with a confirm.Delivery
+        self._ecc_constants = ecc_constants  # for echoes of packets submitted without their own
+        self._pack = 1 if confirm else pack  # each confirmed packet needs its own echo
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._pending = OrderedDict()  # key -> _Command, oldest first
+        self._closed = False
+        self.submitted = 0
+        self.coalesced = 0  # commands replaced by a newer one before they were sent
+        self.transmitted = 0
+        self.packed = 0  # commands sent in the same radio session as an earlier one
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def radio(self):
+        """The radio, opened on first use by the worker thread"""
+        if self._radio is None:
+            self._radio = open_radio()
+        return self._radio
+
+    def submit(self, key, packet, timeout=None, priority=PRIORITY_NORMAL, ecc_constants=None):
+        """Queue the packet for the key and return a Future that completes when it, or a newer one, is sent
+
+        Blocks while the queue is full, raising queue.Full if that lasts longer than the timeout. The priority is only
+        used by workers that order their queue, like the TransmitScheduler, and the ecc constants the packet was
+        encoded with only to recognize its echo when confirming."""
+        if ecc_constants is None:
+            ecc_constants = self._ecc_constants
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Radio worker is closed")
+            self.submitted += 1
+            command = self._pending.get(key)
+            if command is not None:
+                # last write wins, keeping the original place in the queue
+                command.packet = packet
+                command.ecc_constants = ecc_constants
+                command.futures.append(future)
+                self.coalesced += 1
+                self._requeue(key, command, priority)
+                return future
+            while len(self._pending) >= self._maxsize:
+                if not self._not_full.wait(timeout):
+                    raise Full("Radio worker queue is full")
+                if self._closed:
+                    raise RuntimeError("Radio worker is closed")
+            command = _Command(packet, future, ecc_constants)
+            self._pending[key] = command
+            self._enqueue(key, command, priority)
+            self._not_empty.notify()
+        return future
+
+    def _enqueue(self, key, command, priority):
+        """Hook called with the lock held when a new command is queued"""
+        pass
+
+    def _requeue(self, key, command, priority):
+        """Hook called with the lock held when a newer packet replaces a queued command"""
+        pass
+
+    def _select(self, more=False):
+        """Called with the lock held, return the key of the next command and how long to wait before sending it
+
+        More is set when looking for a command to pack with the ones already taken, it is only taken without a wait."""
+        return next(iter(self._pending)), 0
+
+    def _next(self):
+        """Wait for and remove the next commands to send, up to the pack size of them that are ready, or return None
+        once closed and drained"""
+        with self._lock:
+            while True:
+                if not self._pending:
+                    if self._closed:
+                        return None
+                    self._not_empty.wait()
+                    continue
+                key, delay = self._select()
+                if delay > 0:
+                    # woken early by a new command, which may now go first
+                    self._not_empty.wait(delay)
+                    continue
+                commands = [self._pending.pop(key)]
+                while self._pending and len(commands) < self._pack:
+                    key, delay = self._select(more=True)
+                    if delay > 0:
+                        break
+                    commands.append(self._pending.pop(key))
+                self._not_full.notify(len(commands))
+                return commands
+
+    def _send(self, commands):
+        """Transmit the commands and complete their futures"""
+        sending = []
+        for command in commands:
+            futures = [f for f in command.futures if f.set_running_or_notify_cancel()]
+            if futures:
+                sending.append((command, futures))
+        if not sending:
+            return
+        try:
+            results = self._transmit([command for command, futures in sending])
+            self.transmitted += len(sending)
+            self.packed += len(sending) - 1
+        except Exception as e:
+            logging.exception('Transmission failed')
+            for command, futures in sending:
+                for future in futures:
+                    future.set_exception(e)
+        else:
+            for (command, futures), result in zip(sending, results):
+                for future in futures:
+                    future.set_result(result)
+
+    def _transmit(self, commands):
+        """Put the commands on air in one radio session and return the result for each one's futures"""
+        if self._confirm:
+            return [send_confirmed(self.radio, command.packet, ecc_constants=command.ecc_constants)
+                    for command in commands]
+        if len(commands) == 1:
+            return [transmit(self.radio, commands[0].packet)]
+        transmit_packed(self.radio, [command.packet for command in commands])
+        return [None] * len(commands)
+
+    def _run(self):
+        while True:
+            commands = self._next()
+            if commands is None:
+                return
+            self._send(commands)
+
+    def close(self, wait=True):
+        """Stop accepting commands, send whatever is queued, and stop the thread"""
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+        if wait:
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+"""
+registry.py: Many fireplaces driven by one controller, keyed by serial number.
+
+Group commands, like turning everything off at night or setting a scene for a few rooms, check every value first,
+encode all the packets in one pass and then put them on air back to back in a single radio session, so the radio is
+only prepared once and the bursts are packed into as few USB transfers as fit, see packer.py. The radio is a
+SharedRadio, so group commands and commands for single fireplaces from other threads never overlap on air.
+"""
+
+import json
+import os
+from collections import OrderedDict
+
+from .fireplace import Fireplace, validate
+from .journal import StateJournal
+from .packer import transmit_packed
+from .radio import SharedRadio, SimulatedBackend
+
+
+def fireplace_id(serial):
+    """Id used for a fireplace in urls, the three serial words as hex joined by dashes"""
+    return '-'.join('{:03x}'.format(int(word, 2)) for word in serial)
+
+
+def from_environment(environ=None):
+    """Build the registry the servers use, configured by environment variables
+
+    SMARTFIRE_SIMULATE=1 runs without a transceiver, SMARTFIRE_FIREPLACES names a JSON file listing the fireplaces
+    (see FireplaceRegistry.from_config), otherwise there is one with the default serial, and SMARTFIRE_JOURNAL names a
+    directory for remembering the states across restarts."""
+    environ = os.environ if environ is None else environ
+    radio = SimulatedBackend() if environ.get('SMARTFIRE_SIMULATE') else None
+    if environ.get('SMARTFIRE_FIREPLACES'):
+        registry = FireplaceRegistry.from_config(environ['SMARTFIRE_FIREPLACES'], radio)
+    else:
+        registry = FireplaceRegistry(radio)
+        registry.create(None)
+    if environ.get('SMARTFIRE_JOURNAL'):
+        registry.attach_journal(StateJournal(environ['SMARTFIRE_JOURNAL']))
+    return registry
+
+
+class FireplaceRegistry(object):
+    """Fireplaces sharing one radio, with group commands sent in a single radio session"""
+
+    def __init__(self, radio=None):
+        self._radio = SharedRadio(radio)  # the RfCat dongle is opened on first use if not given
+        self._fireplaces = OrderedDict()  # id -> Fireplace
+        self._journal = None
+
+    @classmethod
+    def from_config(cls, path, radio=None):
+        """Load the fireplaces from a JSON list of {"serial": [...], "ecc_constants": [[C1, D1], [C2, D2]]}"""
+        registry = cls(radio)
+        with open(path) as config:
+            for entry in json.load(config):
+                registry.create(entry['serial'], entry.get('ecc_constants'))
+        return registry
+
+    @property
+    def journal(self):
+        """The StateJournal attached to the fireplaces, or None"""
+        return self._journal
+
+    @property
+    def radio(self):
+        """The SharedRadio of every fireplace created here"""
+        return self._radio
+
+    def add(self, fireplace):
+        """Add a fireplace and return its id"""
+        key = fireplace_id(fireplace.serial)
+        if key in self._fireplaces:
+            raise ValueError("Fireplace {} is already registered".format(key))
+        self._fireplaces[key] = fireplace
+        return key
+
+    def create(self, serial, ecc_constants=None, **options):
+        """Create a fireplace on the shared radio, add it and return it"""
+        fireplace = Fireplace(serial, ecc_constants=ecc_constants, radio=self.radio, **options)
+        self.add(fireplace)
+        return fireplace
+
+    def get(self, key):
+        """The fireplace with the given id, raising KeyError if there is none"""
+        return self._fireplaces[key]
+
+    def ids(self):
+        return list(self._fireplaces)
+
+    def __contains__(self, key):
+        return key in self._fireplaces
+
+    def __iter__(self):
+        return iter(self._fireplaces.values())
+
+    def __len__(self):
+        return len(self._fireplaces)
+
+    def set_group(self, ids, force=False, **values):
+        """Set the same values on each of the given fireplaces and transmit them in one radio session"""
+        return self.scene(OrderedDict((key, values) for key in ids), force)
+
+    def scene(self, scene, force=False):
+        """Set values per fireplace, given as {id: {name: value}}, and transmit them in one radio session
+
+        Every id and value is checked before any fireplace changes, and the new states are only staged until the
+        transmission succeeds, so a bad entry or a failed send leaves the whole group as it was. Fireplaces already in
+        their target state are skipped unless force is set, see Fireplace.due. Returns the ids that were sent."""
+        members = [(key, self.get(key), values) for key, values in scene.items()]
+        for key, fireplace, values in members:
+            validate(**values)
+        # take every member's writer lock in id order, so concurrent groups can not deadlock
+        locks = [self.get(key).lock for key in sorted(scene)]
+        for lock in locks:
+            lock.acquire()
+        try:
+            staged = [(key, fireplace, fireplace.snapshot.replace(**values)) for key, fireplace, values in members]
+            packets = []
+            sent = []
+            for key, fireplace, state in staged:
+                if not fireplace.due(force, state):
+                    fireplace.transmissions_avoided += 1
+                    continue
+                packets.append(bytes(fireplace.encode(state)))  # copy, the encoder reuses its buffer
+                sent.append((key, fireplace, state))
+            self.transmit(packets)
+            for key, fireplace, state in staged:
+                fireplace.restore(state)
+            for key, fireplace, state in sent:
+                fireplace.record_sent(state)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+        return [key for key, fireplace, state in sent]
+
+    def all_off(self, force=False):
+        """Turn every fireplace off, for the whole house at night"""
+        return self.set_group(self.ids(), force, power=False)
+
+    def attach_journal(self, journal):
+        """Restore every fireplace to its last state in the StateJournal, and record each state sent from now on"""
+        for fireplace in self:
+            state = journal.state(fireplace.serial)
+            if state is not None:
+                fireplace.restore(state)
+            fireplace.add_listener(journal.record)
+        self._journal = journal
+
+    @property
+    def stats(self):
+        """Transmissions performed and avoided by each fireplace"""
+        return OrderedDict((key, fireplace.transmission_stats) for key, fireplace in self._fireplaces.items())
+
+    def transmit(self, packets):
+        """Put the encoded packets on air back to back, packed into as few USB transfers as the radio allows"""
+        return transmit_packed(self.radio, packets)
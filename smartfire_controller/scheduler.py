@@ -0,0 +1,143 @@
+#!/usr/bin/python
+"""
+scheduler.py: Airtime aware transmit scheduling in front of the radio.
+
+Every burst occupies the channel for its encoded length times the number of copies at the radio data rate, about
+0.42 seconds for a Proflame 2 command. The scheduler sends pending commands highest priority first, so a command that
+turns a fireplace off jumps ahead of queued light and fan changes, and holds commands back whenever sending them would
+exceed the duty cycle budget over a sliding window. Safety commands are never held back, they borrow from the budget
+and are counted as overruns. The airtime of a command is booked when it is taken from the queue, so the commands
+packed into one radio session share the budget like any others.
+"""
+
+import heapq
+import itertools
+import time
+from collections import deque
+
+from .fireplace import PRIORITY_SAFETY
+from .codec import DEFAULT_ECC_CONSTANTS
+from .radio import DATA_RATE, REPEAT
+from .radio_worker import DEFAULT_PACK, DEFAULT_QUEUE_SIZE, RadioWorker
+
+# Default duty cycle budget: the fraction of each window the radio may spend transmitting
+DEFAULT_DUTY_CYCLE = 0.1
+DEFAULT_WINDOW = 60.0  # seconds
+
+
+def airtime(packet_bytes, data_rate=DATA_RATE, repeat=REPEAT):
+    """Seconds on air for a burst of the packet and its repeats"""
+    return packet_bytes * 8 * (repeat + 1) / float(data_rate)
+
+
+class TransmitScheduler(RadioWorker):
+    """Radio worker that orders commands by priority and enforces a duty cycle budget"""
+
+    def __init__(self, radio=None, maxsize=DEFAULT_QUEUE_SIZE, duty_cycle=DEFAULT_DUTY_CYCLE, window=DEFAULT_WINDOW,
+                 data_rate=DATA_RATE, repeat=REPEAT, name='radio-scheduler', confirm=False,
+                 ecc_constants=DEFAULT_ECC_CONSTANTS, pack=DEFAULT_PACK):
+        if not 0 < duty_cycle <= 1:
+            raise ValueError("Duty cycle must be greater than 0 and at most 1")
+        self._budget = duty_cycle * window
+        self._window = window
+        self._data_rate = data_rate
+        self._repeat = repeat
+        self._heap = []  # (-priority, sequence, key), entries for replaced commands are skipped
+        self._sequence = itertools.count()
+        self._history = deque()  # (start time, airtime) of bursts inside the window
+        self.airtime_total = 0.0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.deferred = 0  # times the next command was held back by the budget
+        self.overrun = 0  # safety commands sent over the budget
+        super(TransmitScheduler, self).__init__(radio, maxsize, name, confirm, ecc_constants, pack)
+
+    def _enqueue(self, key, command, priority):
+        command.priority = priority
+        command.sequence = next(self._sequence)
+        heapq.heappush(self._heap, (-priority, command.sequence, key))
+
+    def _requeue(self, key, command, priority):
+        # the newest packet keeps its place in line with its own priority, so a power on replacing a queued power off
+        # loses the safety priority, the entry for the old priority is skipped as stale
+        if priority != command.priority:
+            command.priority = priority
+            heapq.heappush(self._heap, (-priority, command.sequence, key))
+
+    def _airtime_used(self, now):
+        """Airtime spent inside the window ending now, dropping bursts that have left it"""
+        while self._history and self._history[0][0] + self._window <= now:
+            self._history.popleft()
+        return sum(seconds for start, seconds in self._history)
+
+    def _book(self, now, seconds):
+        """Count the airtime as spent from now on, called with the lock held"""
+        self._history.append((now, seconds))
+        self.airtime_total += seconds
+
+    def _select(self, more=False):
+        while True:
+            priority, sequence, key = self._heap[0]
+            command = self._pending.get(key)
+            if command is not None and command.sequence == sequence and command.priority == -priority:
+                break
+            heapq.heappop(self._heap)  # stale entry for a command that was sent or reprioritized
+        now = time.time()
+        needed = airtime(len(command.packet), self._data_rate, self._repeat)
+        used = self._airtime_used(now)
+        if used + needed <= self._budget or not self._history:
+            heapq.heappop(self._heap)
+            self._book(now, needed)
+            return key, 0
+        if command.priority >= PRIORITY_SAFETY:
+            # turning a fireplace off can not wait for the window to clear
+            self.overrun += 1
+            heapq.heappop(self._heap)
+            self._book(now, needed)
+            return key, 0
+        # wait until enough of the oldest bursts leave the window
+        excess = used + needed - self._budget
+        if not more:
+            self.deferred += 1
+        for start, seconds in self._history:
+            excess -= seconds
+            if excess <= 0:
+                return key, start + self._window - now
+        return key, self._history[-1][0] + self._window - now
+
+    def _transmit(self, commands):
+        start = time.time()
+        with self._lock:
+            for command in commands:
+                wait = start - command.queued
+                self.queue_wait_total += wait
+                self.queue_wait_max = max(self.queue_wait_max, wait)
+        results = super(TransmitScheduler, self)._transmit(commands)
+        for command, result in zip(commands, results):
+            attempts = getattr(result, 'attempts', 1)  # confirmed sends may have retransmitted
+            if attempts > 1:
+                seconds = airtime(len(command.packet), self._data_rate, self._repeat)
+                with self._lock:
+                    self._book(time.time(), seconds * (attempts - 1))
+        return results
+
+    @property
+    def stats(self):
+        """Counters for sizing how many fireplaces one radio can drive"""
+        with self._lock:
+            used = self._airtime_used(time.time())
+            return {
+                'queued': len(self._pending),
+                'submitted': self.submitted,
+                'coalesced': self.coalesced,
+                'transmitted': self.transmitted,
+                'packed': self.packed,
+                'deferred': self.deferred,
+                'overrun': self.overrun,
+                'queue_wait_total': self.queue_wait_total,
+                'queue_wait_max': self.queue_wait_max,
+                'airtime_total': self.airtime_total,
+                'airtime_window': used,
+                'budget': self._budget,
+                'headroom': self._budget - used,
+            }
@@ -1,36 +1,98 @@
 #!/usr/bin/python
 """
 server.py: REST sever providing access to the Proflame 2 controller
+
+Build the app with create_app(), for example 'gunicorn -w 4 "server:create_app()"' with SMARTFIRE_BROKER pointing at
+a running broker.py, since only one process may open the radio.
 """
 import json
 import logging
+import os
+
+from flask import Flask, Response, request, jsonify
+
+if not __package__:
+    # run as a script, or imported from this directory, load the modules below as part of the package
+    import os
+    import sys
 
-from flask import Flask, request, jsonify
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = os.path.basename(os.path.dirname(os.path.abspath(__file__)))
+    __import__(__package__)
 
-from fireplace import Fireplace
+from .broker import connect
+from .cache import RegistryCache, etag_matches
+from .events import POLL_TIMEOUT, StateEvents, event_stream, parse_event_id, poll_json
+from .registry import from_environment
+from .state import BOOLEAN_FIELDS, LEVEL_FIELDS, json_values, parse_value, turns_off
 
-fp = Fireplace()
+fireplaces = None  # FireplaceRegistry, or broker.RemoteRegistry in a worker process
+fp = None  # the unscoped routes control the first fireplace
+fp_id = None
+events = None
+caches = None  # pre-encoded GET bodies
 app = Flask(__name__)
 
 
-@app.route("/state", methods=['GET', 'PUT'])
+def create_app(registry=None, state_events=None):
+    """Set up the app for a registry and return it
+
+    Without a registry it connects to the broker named by SMARTFIRE_BROKER when that is set, so that any number of
+    worker processes can share the one process owning the radio, and otherwise opens the radio itself as configured
+    by registry.from_environment."""
+    global fireplaces, fp, fp_id, events, caches
+    if registry is None and os.environ.get('SMARTFIRE_BROKER'):
+        registry, state_events = connect(os.environ['SMARTFIRE_BROKER'])
+    elif registry is None:
+        registry = from_environment()
+    fireplaces = registry
+    fp_id = fireplaces.ids()[0]
+    fp = fireplaces.get(fp_id)
+    events = StateEvents(fireplaces) if state_events is None else state_events
+    caches = RegistryCache(fireplaces)
+    return app
+
+
+def cached(response, mimetype='text/html'):
+    """Serve a pre-encoded (etag, body) from the cache, or 304 Not Modified if the client already has it"""
+    etag, body = response
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return Response(status=304, headers={'ETag': etag})
+    return Response(body, mimetype=mimetype, headers={'ETag': etag})
+
+
+@app.route("/state", methods=['GET', 'PUT', 'PATCH'])
 def state():
-    """Get or set the whole fireplace state at one time"""
+    """Get or set the whole fireplace state at one time, or PATCH any of its values in one transmission"""
     if request.method == 'GET':
         app.logger.debug("get state")
-        return jsonify(fp.state)
+        return cached(caches.get(fp_id).state(), 'application/json')
+    elif request.method == 'PATCH':
+        return patch_state(fp)
     elif request.method == 'PUT':
         value = json.loads(request.data)
         app.logger.debug("put state: {}".format(value))
-        fp.set(pilot=value['pilot'], power=value['power'], flame=value['flame'])
+        values = {'pilot': value['pilot'], 'power': value['power'], 'flame': value['flame']}
+        fp.set(force=turns_off(values), **values)
         return str(fp.state)
 
 
+def patch_state(unit):
+    """Check every value in the JSON body, then send them all in one packet and return the new state as JSON"""
+    try:
+        values = json_values(json.loads(request.get_data(as_text=True)))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    app.logger.debug("patch state: {}".format(values))
+    unit.set(force=turns_off(values), **values)
+    return jsonify(unit.state)
+
+
 @app.route("/serial", methods=['GET'])
 def serial():
     """Return the serial number"""
     app.logger.debug("get serial")
-    return str(fp.serial)
+    return cached(caches.get(fp_id).value('serial'))
 
 
 @app.route("/pilot", methods=['GET', 'PUT'])
@@ -38,7 +100,7 @@ def pilot():
     """Get or set the pilot light and return the status"""
     if request.method == 'GET':
         app.logger.debug("get pilot")
-        return str(fp.pilot)
+        return cached(caches.get(fp_id).value('pilot'))
     elif request.method == 'PUT':
         value = request.data == 'True'
         app.logger.debug("put pilot: {}".format(value))
@@ -51,7 +113,7 @@ def light():
     """Get or set the light and return the status"""
     if request.method == 'GET':
         app.logger.debug("get light")
-        return str(fp.light)
+        return cached(caches.get(fp_id).value('light'))
     elif request.method == 'PUT':
         value = int(request.data)
         app.logger.debug("put light: {}".format(value))
@@ -64,7 +126,7 @@ def thermostat():
     """Get or set the thermostat and return the status"""
     if request.method == 'GET':
         app.logger.debug("get thermostat")
-        return str(fp.thermostat)
+        return cached(caches.get(fp_id).value('thermostat'))
     elif request.method == 'PUT':
         value = request.data == 'True'
         app.logger.debug("put thermostat: {}".format(value))
@@ -77,11 +139,11 @@ def power():
     """Get or set the power and return the status"""
     if request.method == 'GET':
         app.logger.debug("get power")
-        return str(fp.power)
+        return cached(caches.get(fp_id).value('power'))
     elif request.method == 'PUT':
         value = request.data == 'True'
         app.logger.debug("put power: {}".format(value))
-        fp.power = value
+        fp.set(power=value, force=not value)
         return str(fp.power)
 
 
@@ -90,7 +152,7 @@ def front():
     """Get or set the front flame and return the status"""
     if request.method == 'GET':
         app.logger.debug("get front")
-        return str(fp.front)
+        return cached(caches.get(fp_id).value('front'))
     elif request.method == 'PUT':
         value = request.data == 'True'
         app.logger.debug("put front: {}".format(value))
@@ -103,7 +165,7 @@ def fan():
     """Get or set the fan and return the status"""
     if request.method == 'GET':
         app.logger.debug("get fan")
-        return str(fp.fan)
+        return cached(caches.get(fp_id).value('fan'))
     elif request.method == 'PUT':
         value = int(request.data)
         app.logger.debug("put fan: {}".format(value))
@@ -116,7 +178,7 @@ def aux():
     """Get or set the auxiliary power and return the status"""
     if request.method == 'GET':
         app.logger.debug("get aux")
-        return str(fp.aux)
+        return cached(caches.get(fp_id).value('aux'))
     elif request.method == 'PUT':
         value = request.data == 'True'
         app.logger.debug("put aux: {}".format(value))
@@ -129,7 +191,7 @@ def flame():
     """Get or set the flame level and return the status"""
     if request.method == 'GET':
         app.logger.debug("get flame")
-        return str(fp.flame)
+        return cached(caches.get(fp_id).value('flame'))
     elif request.method == 'PUT':
         value = int(request.data)
         app.logger.debug("put flame: {}".format(value))
@@ -137,5 +199,97 @@ def flame():
         return str(fp.flame)
 
 
+@app.route("/fireplaces", methods=['GET'])
+def fireplace_list():
+    """Return the state of every fireplace by id"""
+    return cached(caches.all(), 'application/json')
+
+
+@app.route("/fireplaces/stats", methods=['GET'])
+def fireplace_stats():
+    """Return the transmissions performed and avoided for each fireplace"""
+    return jsonify(fireplaces.stats)
+
+
+@app.route("/fireplaces/off", methods=['POST'])
+def fireplaces_off():
+    """Turn every fireplace off in one radio session"""
+    app.logger.debug("all off")
+    return jsonify(fireplaces.all_off(force=True))
+
+
+@app.route("/scene", methods=['PUT'])
+def scene():
+    """Set values on several fireplaces at once, given as {id: {name: value}}, in one radio session"""
+    value = json.loads(request.data)
+    app.logger.debug("put scene: {}".format(value))
+    missing = [key for key in value if key not in fireplaces]
+    if missing:
+        return jsonify({'error': 'Unknown fireplaces {}'.format(missing)}), 404
+    try:
+        fireplaces.scene(value)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({key: fireplaces.get(key).state for key in value})
+
+
+@app.route("/fireplaces/<key>/state", methods=['GET', 'PUT', 'PATCH'])
+def fireplace_state(key):
+    """Get or set the whole state of one fireplace"""
+    if key not in fireplaces:
+        return jsonify({'error': 'Unknown fireplace {}'.format(key)}), 404
+    unit = fireplaces.get(key)
+    if request.method == 'GET':
+        return cached(caches.get(key).state(), 'application/json')
+    if request.method == 'PATCH':
+        return patch_state(unit)
+    if request.method == 'PUT':
+        value = json.loads(request.data)
+        app.logger.debug("put {} state: {}".format(key, value))
+        try:
+            fireplaces.scene({key: value})
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+    return jsonify(unit.state)
+
+
+@app.route("/fireplaces/<key>/<name>", methods=['GET', 'PUT'])
+def fireplace_value(key, name):
+    """Get or set one value of one fireplace and return the status"""
+    if key not in fireplaces or name not in BOOLEAN_FIELDS + LEVEL_FIELDS:
+        return 'Not found', 404
+    unit = fireplaces.get(key)
+    if request.method == 'GET':
+        return cached(caches.get(key).value(name))
+    if request.method == 'PUT':
+        try:
+            value = parse_value(name, request.get_data(as_text=True))
+            app.logger.debug("put {} {}: {}".format(key, name, value))
+            unit.set(force=turns_off({name: value}), **{name: value})
+        except ValueError as e:
+            return str(e), 400
+    return str(getattr(unit, name))
+
+
+@app.route("/events", methods=['GET'])
+def event_source():
+    """Stream state changes as Server-Sent Events, resuming after the Last-Event-ID header when reconnecting"""
+    last = parse_event_id(request.headers.get('Last-Event-ID', request.args.get('since')))
+    app.logger.debug("events since {}".format(last))
+    return Response(event_stream(events, last), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route("/events/poll", methods=['GET'])
+def event_poll():
+    """Long poll for the state changes after the since event id, waiting up to timeout seconds for one"""
+    last = parse_event_id(request.args.get('since'))
+    try:
+        timeout = min(float(request.args.get('timeout', POLL_TIMEOUT)), POLL_TIMEOUT)
+    except ValueError:
+        return 'Bad timeout', 400
+    return Response(poll_json(events.wait(last, timeout), last), mimetype='application/json')
+
+
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=5000, debug=True)  # start the rest server
+    create_app().run(host='0.0.0.0', port=5000)  # start the rest server, for development, see fireplace.service
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+"""
+state.py: Compact immutable fireplace state packed into the two command bytes.
+
+The whole state is the 16 bit integer (command1 << 8) | command2, exactly what goes on air, so a state costs one small
+object, compares and hashes as an int, and can be used directly as a cache key, a diff input or a history entry.
+"""
+
+from .codec import FIELDS, MAX_LEVEL, decode_command_bytes
+
+# (shift, width) of each value in the 16 bit state
+BIT_FIELDS = {
+    'pilot': (15, 1),
+    'light': (12, 3),
+    'thermostat': (9, 1),
+    'power': (8, 1),
+    'front': (7, 1),
+    'fan': (4, 3),
+    'aux': (3, 1),
+    'flame': (0, 3),
+}
+
+# Values that are on/off switches and values that are 0 to 6 levels, in FIELDS order
+BOOLEAN_FIELDS = tuple(name for name in FIELDS if BIT_FIELDS[name][1] == 1)
+LEVEL_FIELDS = tuple(name for name in FIELDS if BIT_FIELDS[name][1] > 1)
+
+
+def parse_value(name, text):
+    """Parse a value written as plain text, True or False for switches and a number for levels"""
+    if name in LEVEL_FIELDS:
+        return int(text)
+    return text.strip() == 'True'
+
+
+def turns_off(values):
+    """Whether the values explicitly turn the power off
+
+    A user asking for off is always transmitted, as force, since the handheld remote may have turned the fireplace on
+    without the controller knowing."""
+    return values.get('power') is False
+
+
+def json_values(body):
+    """Check a JSON object of values to change, returning them as a dict ready for Fireplace.set
+
+    Any subset of the values may be given. Switches must be true or false, levels whole numbers from 0 to 6, and an
+    echoed serial is ignored. Raises ValueError for anything else."""
+    if not isinstance(body, dict):
+        raise ValueError("State must be a JSON object")
+    values = {}
+    for name, value in body.items():
+        if name == 'serial':
+            continue
+        if name in BOOLEAN_FIELDS and not isinstance(value, bool):
+            raise ValueError("{} must be true or false".format(name.capitalize()))
+        if name in LEVEL_FIELDS and (isinstance(value, bool) or not isinstance(value, int)):
+            raise ValueError("{} must be a whole number".format(name.capitalize()))
+        values[name] = value
+    FireplaceState().replace(**values)
+    return values
+
+
+def _field(name):
+    shift, width = BIT_FIELDS[name]
+    mask = (1 << width) - 1
+    if width == 1:
+        return property(lambda self: bool((self._bits >> shift) & mask), doc='The {} switch'.format(name))
+    return property(lambda self: (self._bits >> shift) & mask, doc='The {} level, 0 to 6'.format(name))
+
+
+class FireplaceState(object):
+    """Immutable fireplace state stored as the two command bytes in a single int"""
+    __slots__ = ('_bits',)
+
+    def __init__(self, bits=0):
+        if not 0 <= bits <= 0xFFFF:
+            raise ValueError("State bits must fit in 16 bits")
+        object.__setattr__(self, '_bits', bits)
+
+    @classmethod
+    def from_values(cls, pilot=False, light=0, thermostat=False, power=False, front=False, fan=0, aux=False, flame=0):
+        return cls().replace(pilot=pilot, light=light, thermostat=thermostat, power=power, front=front, fan=fan,
+                             aux=aux, flame=flame)
+
+    @classmethod
+    def from_bytes(cls, cmd1, cmd2):
+        return cls((cmd1 << 8) | cmd2)
+
+    pilot = _field('pilot')
+    light = _field('light')
+    thermostat = _field('thermostat')
+    power = _field('power')
+    front = _field('front')
+    fan = _field('fan')
+    aux = _field('aux')
+    flame = _field('flame')
+
+    @property
+    def bits(self):
+        return self._bits
+
+    @property
+    def command_bytes(self):
+        """The data bytes of the two command words"""
+        return self._bits >> 8, self._bits & 0xFF
+
+    @property
+    def values(self):
+        """Tuple in FIELDS order"""
+        return decode_command_bytes(self._bits >> 8, self._bits & 0xFF)
+
+    def replace(self, **values):
+        """Return a new state with the given values changed, None values are left as they are
+
+        Raises ValueError for unknown names and levels outside 0 to 6, before anything is changed."""
+        bits = self._bits
+        for name, value in values.items():
+            if name not in BIT_FIELDS:
+                raise ValueError("Unknown fireplace value {}".format(name))
+            if value is None:
+                continue
+            shift, width = BIT_FIELDS[name]
+            if width == 1:
+                value = bool(value)
+            elif not 0 <= value <= MAX_LEVEL:
+                raise ValueError("{} value must be between 0 and 6 inclusive".format(name.capitalize()))
+            bits = (bits & ~(((1 << width) - 1) << shift)) | (int(value) << shift)
+        if bits == self._bits:
+            return self
+        return FireplaceState(bits)
+
+    def as_dict(self):
+        """The values by name, for JSON"""
+        return dict(zip(FIELDS, self.values))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("FireplaceState is immutable")
+
+    def __eq__(self, other):
+        return isinstance(other, FireplaceState) and self._bits == other._bits
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._bits)
+
+    def __int__(self):
+        return self._bits
+
+    def __reduce__(self):
+        return FireplaceState, (self._bits,)
+
+    def __repr__(self):
+        return 'FireplaceState({})'.format(', '.join('{}={}'.format(n, v) for n, v in zip(FIELDS, self.values)))